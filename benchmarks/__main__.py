@@ -0,0 +1,331 @@
+"""
+Offline benchmarks of preprocess, upload, ask and weather against fake services,
+and recall of Chroma's approximate search against exact search of NumPy backend.
+Partitioning models, NLTK data and tiktoken encodings must be downloaded before.
+
+    python -m benchmarks --output results.json --baseline previous.json
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+from unittest.mock import patch
+
+import click
+
+from benchmarks.fakes import (
+    FakeAPI,
+    FakeEmbeddingFunction,
+    synthetic_jsonl,
+    synthetic_pdf,
+)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss() -> float:
+    """
+    Peak resident memory of the process in megabytes,
+    unlike `tracemalloc` it counts allocations of native libraries
+    """
+    with contextlib.suppress(OSError):
+        status = Path("/proc/self/status").read_text()
+        if found := re.search(r"^VmHWM:\s+(\d+) kB", status, re.MULTILINE):
+            return int(found[1]) / 2**10
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def measured(run: Callable[[], Any]) -> tuple[Any, float, float]:
+    """
+    Result, seconds and peak resident memory in megabytes.
+    Elsewhere than on Linux the peak is the one since the process start.
+    """
+    with contextlib.suppress(OSError):
+        Path("/proc/self/clear_refs").write_text("5")  # resets the peak
+    started = time.perf_counter()
+    with contextlib.redirect_stderr(io.StringIO()):  # per-call diagnostics
+        result = run()
+    return result, time.perf_counter() - started, peak_rss()
+
+
+def latencies(run: Callable[[int], Any], count: int) -> dict[str, float]:
+    def timed() -> list[float]:
+        spent = []
+        for index in range(count):
+            started = time.perf_counter()
+            run(index)
+            spent.append(time.perf_counter() - started)
+        return spent
+
+    spent, elapsed, peak = measured(timed)
+    return {
+        "count": count,
+        "seconds": elapsed,
+        "per_second": count / elapsed,
+        "p50": percentile(spent, 0.5),
+        "p99": percentile(spent, 0.99),
+        "peak_rss_mb": peak,
+    }
+
+
+@contextlib.contextmanager
+def patch_stdin(stream: io.StringIO) -> Iterator[None]:
+    stdin, sys.stdin = sys.stdin, stream
+    try:
+        yield
+    finally:
+        sys.stdin = stdin
+
+
+def bench_preprocess(
+    workdir: Path, api: FakeAPI, sizes: list[int], strategy: str
+) -> list[dict]:
+    from ulm.pdf import pdf_to_elements
+
+    results = []
+    for pages in sizes:
+        pdf = workdir.joinpath(f"document-{pages}.pdf")
+        synthetic_pdf(pdf, pages)
+        os.environ["ULM_CACHE"] = str(workdir.joinpath(f"cache-{pages}"))
+        requests = sum(api.requests.values())
+        with (
+            contextlib.redirect_stdout(io.StringIO()),
+            patch_stdin(io.StringIO("\n" * 10**6)),  # default for confirmations
+        ):
+            elements, elapsed, peak = measured(
+                lambda: pdf_to_elements(
+                    pdf, pages=max(1, pages // 4), strategy=strategy
+                )
+            )
+        results.append(
+            {
+                "stage": "preprocess",
+                "size": pages,
+                "elements": len(elements),
+                "seconds": elapsed,
+                "per_second": pages / elapsed,
+                "peak_rss_mb": peak,
+                "llm_requests": sum(api.requests.values()) - requests,
+            }
+        )
+    return results
+
+
+def bench_upload(workdir: Path, sizes: list[int], batch_size: int) -> list[dict]:
+    from ulm.pdf import ChromaFactory
+    from ulm.vectors import NumpyIndex
+
+    results = []
+    for elements in sizes:
+        jsonl = workdir.joinpath(f"elements-{elements}.jsonl")
+        synthetic_jsonl(jsonl, elements)
+        for backend in ["chroma", "numpy"]:
+            db = workdir.joinpath(f"db-{backend}-{elements}")
+            upload: Callable[[], Any]
+            if backend == "numpy":
+                upload = lambda: NumpyIndex.build(
+                    ChromaFactory.batches(jsonl, batch_size),
+                    db,
+                    ChromaFactory.embedding_function(),
+                )
+            else:
+                upload = lambda: ChromaFactory.from_jsonl(jsonl, db, batch_size)
+            _, elapsed, peak = measured(upload)
+            results.append(
+                {
+                    "stage": f"upload-{backend}",
+                    "size": elements,
+                    "seconds": elapsed,
+                    "per_second": elements / elapsed,
+                    "peak_rss_mb": peak,
+                }
+            )
+    return results
+
+
+def bench_ask(workdir: Path, elements: int, questions: int) -> list[dict]:
+    from ulm.pdf import ChromaFactory, rag_ask
+
+    results = []
+    for backend in ["chroma", "numpy"]:
+        storage = ChromaFactory.storage(workdir.joinpath(f"db-{backend}-{elements}"))
+        asked = [f"How is water {word} repaired?" for word in range(questions)]
+        results.append(
+            {
+                "stage": f"ask-{backend}",
+                "size": elements,
+                **latencies(lambda index: rag_ask(storage, asked[index]), questions),
+            }
+        )
+    return results
+
+
+def bench_recall(workdir: Path, elements: int, questions: int, k: int = 10) -> dict:
+    """
+    Share of exact top `k` neighbours found by Chroma for sentences of documents
+    """
+    from ulm.pdf import ChromaFactory
+
+    chroma = ChromaFactory.storage(workdir.joinpath(f"db-chroma-{elements}"))
+    exact = ChromaFactory.storage(workdir.joinpath(f"db-numpy-{elements}"))
+    documents = exact.query(query_texts="water", n_results=questions)["documents"][0]
+    asked = [document.split(". ")[0] for document in documents]
+    found = chroma.query(query_texts=asked, n_results=k, include=[])["ids"]
+    expected = exact.query(query_texts=asked, n_results=k, include=[])["ids"]
+    recall = [len(set(a) & set(b)) / len(b) for a, b in zip(found, expected)]
+    return {
+        "stage": "recall",
+        "size": elements,
+        "k": k,
+        "questions": len(asked),
+        "recall": sum(recall) / len(recall),
+        "min_recall": min(recall),
+    }
+
+
+def bench_weather(workdir: Path, requests: int) -> list[dict]:
+    from ulm.weather import WeatherCache, current_weather
+
+    cache = WeatherCache(workdir.joinpath("weather"))
+    return [
+        {
+            "stage": "weather",
+            "size": requests,
+            **latencies(lambda index: current_weather("1", str(index)), requests),
+        },
+        {
+            "stage": "weather-cached",
+            "size": requests,
+            **latencies(lambda index: current_weather("1", "1", cache=cache), requests),
+        },
+    ]
+
+
+def compare(results: list[dict], baseline: list[dict]) -> None:
+    before = {(r["stage"], r["size"]): r for r in baseline}
+    click.echo(f"{'stage':<16}{'size':>8}{'seconds':>10}{'baseline':>10}{'change':>9}")
+    for result in results:
+        key = (result["stage"], result["size"])
+        if "seconds" not in result or "seconds" not in before.get(key, {}):
+            continue
+        old = before[key]["seconds"]
+        click.echo(
+            f"{result['stage']:<16}{result['size']:>8}{result['seconds']:>10.3f}"
+            f"{old:>10.3f}{result['seconds'] / old - 1:>+9.1%}"
+        )
+
+
+def sizes_option(value: str) -> list[int]:
+    return [int(size) for size in value.split(",")]
+
+
+@click.command()
+@click.option("--output", type=click.Path(path_type=Path), default=None)
+@click.option("--baseline", type=click.Path(exists=True, path_type=Path), default=None)
+@click.option("--latency", type=float, default=0.05, help="Seconds per fake API response")
+@click.option("--rate-limited", type=float, default=0.05, help="Share of 429 responses")
+@click.option("--pages", default="2,8,32", help="Sizes of synthetic PDFs")
+@click.option("--elements", default="1000,5000,20000", help="Sizes of synthetic JSONL")
+@click.option("--questions", type=int, default=50, help="Questions asked per backend")
+@click.option(
+    "--strategy", default="fast", help="Partitioning strategy, hi_res needs OCR models"
+)
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(["preprocess", "upload", "ask", "recall", "weather"]),
+    help="Run only these stages",
+)
+def cli(
+    output: Optional[Path],
+    baseline: Optional[Path],
+    latency: float,
+    rate_limited: float,
+    pages: str,
+    elements: str,
+    questions: int,
+    strategy: str,
+    stages: tuple[str, ...],
+) -> None:
+    stages = stages or ("preprocess", "upload", "ask", "recall", "weather")
+    element_sizes = sizes_option(elements)
+    results: list[dict] = []
+    with FakeAPI(latency, rate_limited) as api, tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        os.environ.update(
+            {
+                "OPENAI_API_KEY": "fake",
+                "OPENAI_API_BASE": f"{api.url}/v1",
+                "OPENAI_TPM": "1000000000",
+                "OPENWEATHERMAP_API_BASE": f"{api.url}/data/2.5",
+                "OPENWEATHERMAP_KEY": "fake",
+            }
+        )
+        from ulm.pdf import ChromaFactory
+
+        def uploaded() -> None:
+            if not workdir.joinpath(f"db-numpy-{element_sizes[-1]}").exists():
+                bench_upload(workdir, element_sizes[-1:], 256)
+
+        def ask() -> list[dict]:
+            uploaded()
+            return bench_ask(workdir, element_sizes[-1], questions)
+
+        def recall() -> list[dict]:
+            uploaded()
+            return [bench_recall(workdir, element_sizes[-1], questions)]
+
+        runs: dict[str, Callable[[], list[dict]]] = {
+            "preprocess": lambda: bench_preprocess(
+                workdir, api, sizes_option(pages), strategy
+            ),
+            "upload": lambda: bench_upload(workdir, element_sizes, 256),
+            "ask": ask,
+            "recall": recall,
+            "weather": lambda: bench_weather(workdir, questions),
+        }
+
+        with patch.object(
+            ChromaFactory,
+            "embedding_function",
+            return_value=FakeEmbeddingFunction(),
+        ):
+            for stage in stages:
+                click.echo(f"Running {stage}", err=True)
+                try:
+                    results += runs[stage]()
+                except Exception as e:
+                    results.append({"stage": stage, "error": repr(e)})
+        rate_limited_count = api.requests["429"]
+
+    for result in results:
+        click.echo(json.dumps(result))
+    click.echo(f"Fake API answered 429 {rate_limited_count} times", err=True)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "latency": latency,
+        "rate_limited": rate_limited,
+        "results": results,
+    }
+    if output is not None:
+        output.write_text(json.dumps(report, indent=2))
+    if baseline is not None:
+        compare(results, json.loads(baseline.read_text())["results"])
+
+
+if __name__ == "__main__":
+    cli()
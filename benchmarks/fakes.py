@@ -0,0 +1,252 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+WORDS = (
+    "water repair city infrastructure labor pipe network maintenance team workers"
+    " grid leak patchwork austerity practice system urban soil flow breakdown"
+    " adaptation improvisation knowledge rupture pressure valve district service"
+).split()
+
+HOST = "127.0.0.1"
+
+
+class FakeAPI(ThreadingHTTPServer):
+    """
+    OpenAI completions and OpenWeatherMap current weather on localhost.
+    Every response takes `latency` seconds, `rate_limited` share of
+    requests is answered with 429.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, latency: float = 0.0, rate_limited: float = 0.0, seed: int = 0
+    ) -> None:
+        super().__init__((HOST, 0), FakeHandler)
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests: Counter[str] = Counter()
+
+    @property
+    def url(self) -> str:
+        return f"http://{HOST}:{self.server_port}"
+
+    def limited(self, path: str) -> bool:
+        with self.lock:
+            self.requests[path] += 1
+            if self.random.random() < self.rate_limited:
+                self.requests["429"] += 1
+                return True
+            return False
+
+    def __enter__(self) -> "FakeAPI":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def completion_text(prompt: str) -> str:
+    """
+    Verdict for the last snippet of a single prompt,
+    or a numbered verdict for every snippet of a batch prompt
+    """
+    snippets = prompt.rsplit("\nSnippets:\n", 1)
+    if len(snippets) == 1:
+        snippet = prompt.rsplit("```\n", 2)[-2]
+        return "Fake verdict. " + ("Artifact" if len(snippet) < 30 else "Meaningful")
+
+    numbered = re.findall(r"^\[(\d+)\] ```(.*)```$", snippets[1], re.MULTILINE)
+    return "".join(
+        f"[{number}] Fake verdict. {'Artifact' if len(text) < 30 else 'Meaningful'}\n"
+        for number, text in numbered
+    )
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    server: FakeAPI
+
+    def reply(self, status: int, body: dict, headers: dict[str, str] = {}) -> None:
+        raw = json.dumps(body).encode()
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def respond(self, path: str) -> bool:
+        time.sleep(self.server.latency)
+        if self.server.limited(path):
+            self.reply(
+                429,
+                {"error": {"message": "Rate limit reached"}},
+                {"retry-after": str(max(self.server.latency, 0.01))},
+            )
+            return False
+        return True
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.respond(self.path):
+            return
+
+        if self.path == "/v1/completions":
+            text = completion_text(request["prompt"])
+            self.reply(200, {"choices": [{"text": text}]})
+        elif self.path == "/v1/chat/completions":
+            prompt = "".join(m["content"] for m in request["messages"])
+            self.reply(
+                200,
+                {
+                    "choices": [{"message": {"content": "Fake answer."}}],
+                    "usage": {"prompt_tokens": len(prompt) // 4},
+                },
+            )
+        else:
+            self.send_error(404)
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/data/2.5/weather":
+            self.send_error(404)
+            return
+        if not self.respond(url.path):
+            return
+
+        now = int(time.time())
+        self.reply(
+            200,
+            {
+                "dt": now - 60,
+                "sys": {"sunrise": now - 3600, "sunset": now + 3600},
+                "main": {
+                    "temp": 20.0,
+                    "feels_like": 19.0,
+                    "pressure": 1013,
+                    "humidity": 50,
+                },
+                "wind": {"speed": 3.0},
+                "clouds": {"all": 40},
+            },
+        )
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class FakeEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Deterministic bag of hashed words, so similar texts get similar embeddings
+    """
+
+    def __init__(self, dimensions: int = 384) -> None:
+        self.dimensions = dimensions
+
+    def __call__(self, input: Documents) -> Embeddings:
+        embeddings = np.zeros((len(input), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(input):
+            for word in text.lower().split():
+                digest = hashlib.blake2b(word.encode(), digest_size=4).digest()
+                embeddings[row, int.from_bytes(digest, "little") % self.dimensions] += 1
+        embeddings[:, 0] += 1e-3  # no zero vectors
+        # unit length as of the real model, so L2 of Chroma ranks as cosine
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return list(embeddings)
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text.capitalize() + "."
+
+
+def paragraph(rng: random.Random) -> str:
+    return " ".join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(2, 5)))
+
+
+def synthetic_jsonl(filename: Path, elements: int, seed: int = 0) -> None:
+    """
+    Preprocessed elements in the format of `ulm-pdf preprocess` output
+    """
+    rng = random.Random(seed)
+    with filename.open("w") as fd:
+        for index in range(elements):
+            record = {
+                "type": "NarrativeText",
+                "element_id": hashlib.sha1(f"{seed}-{index}".encode()).hexdigest(),
+                "metadata": {"page_number": index // 8 + 1},
+                "text": paragraph(rng),
+            }
+            fd.write(json.dumps(record) + "\n")
+
+
+def synthetic_pdf(filename: Path, pages: int, seed: int = 0) -> None:
+    """
+    PDF with a running header, page number and wrapped paragraphs on every page
+    """
+    rng = random.Random(seed)
+    objects: list[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # page tree, written when all pages are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in range(1, pages + 1):
+        lines = ["Journal of Synthetic Studies 0(0)", ""]
+        while len(lines) < 55:
+            text = paragraph(rng).split()
+            while text:
+                lines.append(" ".join(text[:14]))
+                text = text[14:]
+            lines.append("")
+        lines = lines[:55] + [str(page)]
+
+        escaped = [re.sub(r"([()\\])", r"\\\1", line) for line in lines]
+        stream = "BT /F1 10 Tf 13 TL 50 800 Td\n" + "".join(
+            f"({line}) Tj T*\n" for line in escaped
+        ) + "ET"
+        objects.append(
+            f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode()
+        )
+        objects.append(
+            (
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842]"
+                f" /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+            ).encode()
+        )
+        kids.append(len(objects))
+    objects[1] = (
+        f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}]"
+        f" /Count {len(kids)} >>"
+    ).encode()
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    data += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    filename.write_bytes(bytes(data))
@@ -1,8 +0,0 @@
-import os
-
-import dotenv
-import openai
-
-dotenv.load_dotenv()
-
-openai.api_key = os.environ["OPENAI_API_KEY"]
@@ -1,33 +1,226 @@
 import contextlib
+import copy
+import fcntl
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
 import pickle
+import tempfile
+import time
 from pathlib import Path
-from typing import Any, Generator, Iterable, Optional
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    Optional,
+    Protocol,
+    Sequence,
+    TextIO,
+    runtime_checkable,
+)
+
+import ulm.trace as trace
+
+
+def dump_atomic(
+    filename: Path, value: Any, dump: Callable[[Any, BinaryIO], None] = pickle.dump
+) -> None:
+    """
+    Writes `value` with `dump` to a temporary file in the same directory,
+    which then replaces `filename`: a crash never leaves a corrupted file,
+    readers see either the old content or the new one
+    """
+    fd, tmp = tempfile.mkstemp(dir=filename.parent, prefix=f".{filename.name}.")
+    try:
+        with os.fdopen(fd, "wb") as tmpfd, trace.span(
+            "checkpoint.dump", file=filename.name
+        ):
+            dump(value, tmpfd)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 
 class Singular:
-    def __init__(self, filename: Path) -> None:
+    def __init__(
+        self,
+        filename: Path,
+        load: Callable[[BinaryIO], Any] = pickle.load,
+        dump: Callable[[Any, BinaryIO], None] = pickle.dump,
+    ) -> None:
         self.filename = filename
+        self.load = load
+        self.dump = dump
 
     def saved(self) -> Any:
         if self.filename.exists():
-            with self.filename.open("rb") as fd:
-                return pickle.load(fd)
+            with self.filename.open("rb") as fd, trace.span(
+                "checkpoint.load", file=self.filename.name
+            ):
+                return self.load(fd)
         else:
             return None
 
     def save(self, value: Any) -> Any:  # TODO: generic type
-        with self.filename.open("wb") as fd:
-            pickle.dump(value, fd)
+        dump_atomic(self.filename, value, self.dump)
 
         return value
 
 
 @contextlib.contextmanager
-def singular(filename: Path) -> Generator[Singular, None, None]:
-    yield Singular(filename)
+def singular(filename: Path, **kwargs: Any) -> Generator[Singular, None, None]:
+    yield Singular(filename, **kwargs)
+
+
+def digest(filename: Path) -> str:
+    """
+    Hash of the file content
+    """
+    sha = hashlib.sha256()
+    with filename.open("rb") as fd:
+        while chunk := fd.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Store:
+    """
+    Shared directory of checkpoints addressed by the content of their inputs.
+
+    Least recently used checkpoints are evicted when the total size exceeds
+    `max_bytes`. Subdirectories are left to other caches.
+    """
+
+    stats_name = ".stats"
+
+    def __init__(self, directory: Path, max_bytes: int = 2 << 30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def filename(self, *parts: Any, **params: Any) -> Path:
+        key = repr((parts, sorted(params.items()))).encode()
+        return self.directory.joinpath(hashlib.sha256(key).hexdigest())
+
+    def stats(self) -> dict[str, int]:
+        return Singular(self.directory.joinpath(self.stats_name)).saved() or {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    def count(self, hit: bool) -> None:
+        stats = self.stats()
+        stats["hits" if hit else "misses"] += 1
+        dump_atomic(self.directory.joinpath(self.stats_name), stats)
+
+    def evict(self, keep: Path) -> None:
+        entries = [
+            (entry.stat(), entry)
+            for entry in self.directory.iterdir()
+            if not entry.name.startswith(".") and entry.is_file()
+        ]
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, entry in sorted(entries, key=lambda e: e[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            if entry != keep:
+                entry.unlink(missing_ok=True)
+                total -= stat.st_size
+
+
+class Memo(Singular):
+    def __init__(self, store: Store, filename: Path, **kwargs: Any) -> None:
+        super().__init__(filename, **kwargs)
+        self.store = store
+
+    def saved(self) -> Any:
+        value = super().saved()
+        self.store.count(hit=value is not None)
+        if value is not None:
+            os.utime(self.filename)  # mark as recently used
+        return value
+
+    def save(self, value: Any) -> Any:
+        super().save(value)
+        self.store.evict(keep=self.filename)
+        return value
+
+
+@contextlib.contextmanager
+def memoized(
+    store: Store,
+    *parts: Any,
+    load: Callable[[BinaryIO], Any] = pickle.load,
+    dump: Callable[[Any, BinaryIO], None] = pickle.dump,
+    **params: Any,
+) -> Generator[Memo, None, None]:
+    """
+    Same as `singular`, but addressed by inputs: pass `digest` of input files
+    and all parameters that affect the value
+    """
+    yield Memo(store, store.filename(*parts, **params), load=load, dump=dump)
+
+
+@runtime_checkable
+class Seekable(Protocol):
+    """
+    Source which can report and restore its own position,
+    e.g. a byte offset in a file
+    """
+
+    def tell(self) -> Any:
+        """
+        Position of the next item to be yielded
+        """
+
+    def seek(self, position: Any) -> Iterator:
+        """
+        Iterator which starts from the position returned by `tell`
+        """
+
+
+class JsonLines:
+    """
+    Seekable source of JSON objects stored one per line
+    """
+
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self._offset = 0
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.seek(0)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def seek(self, position: int) -> Iterator[Any]:
+        self._offset = position
+        with self.filename.open("rb") as fd:
+            fd.seek(position)
+            for line in fd:
+                self._offset += len(line)
+                yield json.loads(line)
 
 
 class indexed:
+    """
+    Resumable iteration over `iterable`.
+
+    Restart continues right after the last saved item. Time to resume doesn't
+    depend on the number of processed items when the source supports it:
+    - `Seekable` sources continue from the position saved in the checkpoint;
+    - sequences are indexed directly;
+    - any other iterable is replayed, skipping already processed items.
+    """
+
     def __init__(
         self,
         filename: Path,
@@ -36,33 +229,64 @@ class indexed:
         initializer: Optional[Any] = None,
     ) -> None:
         self.filename = filename
-        self.iterable = iterable.__iter__()
+        self.source = iterable
         self.once_in = once_in
         self._context = initializer
 
         self._restore()
 
     def _restore(self) -> None:
-        self._index = 0
+        self.iterable = self._seek(self._load())
+
+    def _load(self) -> Any:
+        self._index, position = 0, None
         if self.filename.exists():
             with self.filename.open("rb") as fd:
-                self._index, self._context = pickle.load(fd)
-                self._index -= 1
+                saved = pickle.load(fd)
+
+            if len(saved) == 2:  # legacy format: replays the last two items
+                self._index, self._context = saved
+                self._index = max(self._index - 1, 0)
+            else:
+                self._index, self._context, position = saved
+
+        return position
+
+    def _seekable(self) -> Optional[Seekable]:
+        if isinstance(self.source, Seekable) and not isinstance(
+            self.source, io.IOBase
+        ):
+            return self.source
+        return None
 
-            for _ in range(self._index):
-                next(self.iterable)
+    def _seek(self, position: Any) -> Iterator:
+        if (source := self._seekable()) is not None and position is not None:
+            return source.seek(position)
+
+        if isinstance(self.source, Sequence):
+            return map(self.source.__getitem__, range(self._index, len(self.source)))
+
+        iterator = iter(self.source)
+        for _ in itertools.islice(iterator, self._index):
+            pass
+        return iterator
+
+    def _position(self) -> Any:
+        if (source := self._seekable()) is not None:
+            return source.tell()
+        return None
 
     def __iter__(self) -> "indexed":
         return self
 
     def __next__(self) -> tuple[int, Any, Any]:
+        item = next(self.iterable)
         index, self._index = self._index, self._index + 1
-        return index, next(self.iterable), self._context
+        return index, item, self._context
 
     def save(self, index: int, context: Any) -> Any:  # TODO: generic type
         if self.once_in is None or (index + 1) % self.once_in == 0:
-            with self.filename.open("wb") as fd:
-                pickle.dump((index, context), fd)
+            dump_atomic(self.filename, (index + 1, context, self._position()))
 
         self._context = context
 
@@ -72,8 +296,7 @@ class indexed:
         """
         Marks finish of iteration
         """
-        with self.filename.open("wb") as fd:
-            pickle.dump((self._index, self._context), fd)
+        dump_atomic(self.filename, (self._index, self._context, self._position()))
         return self._context
 
     def finish(self) -> None:
@@ -81,3 +304,263 @@ class indexed:
         Replacement for the `break` statement
         """
         raise NotImplementedError()
+
+
+class journaled(indexed):
+    """
+    Resumable iteration which stores only changes of the context.
+
+    `save` takes a delta, which is merged into the context with `apply`, and
+    appends it to the journal next to the snapshot `filename`. Restore loads
+    the snapshot and replays the journal on top of it. `saved` compacts the
+    journal into a new snapshot, unless it's kept for `rewind`.
+    """
+
+    def __init__(
+        self,
+        filename: Path,
+        iterable: Iterable,
+        apply: Callable[[Any, Any], Any],
+        once_in: Optional[int] = None,
+        initializer: Optional[Any] = None,
+    ) -> None:
+        self.apply = apply
+        self.journal = filename.with_name(filename.name + ".journal")
+        self._pending: list[Any] = []
+        self._initial = copy.deepcopy(initializer)  # `apply` may change it in place
+        super().__init__(filename, iterable, once_in, initializer)
+
+    def _load(self) -> Any:
+        position = super()._load()
+        if not self.journal.exists():
+            return position
+
+        with self.journal.open("rb+") as fd:
+            while True:
+                offset = fd.tell()
+                try:
+                    next_index, record_position, deltas = pickle.load(fd)
+                except (EOFError, pickle.UnpicklingError):
+                    fd.truncate(offset)  # drop a record interrupted by crash
+                    break
+
+                if next_index <= self._index:  # already in the snapshot
+                    continue
+
+                for delta in deltas:
+                    self._context = self.apply(self._context, delta)
+                self._index, position = next_index, record_position
+
+        return position
+
+    def save(self, index: int, delta: Any) -> Any:
+        self._context = self.apply(self._context, delta)
+        self._pending.append(delta)
+
+        if self.once_in is None or (index + 1) % self.once_in == 0:
+            with self.journal.open("ab") as fd, trace.span("checkpoint.journal"):
+                pickle.dump((index + 1, self._position(), self._pending), fd)
+            self._pending = []
+
+        return self._context
+
+    def _records(self) -> Iterator[tuple[int, Any, list]]:
+        with self.journal.open("rb") as fd:
+            while True:
+                try:
+                    yield pickle.load(fd)
+                except (EOFError, pickle.UnpicklingError):
+                    return
+
+    def saved(self, compact: bool = True) -> Any:
+        """
+        Marks finish of iteration and compacts the journal,
+        without `compact` only flushes it
+        """
+        if not compact:
+            if self._pending:
+                with self.journal.open("ab") as fd:
+                    pickle.dump((self._index, self._position(), self._pending), fd)
+                self._pending = []
+            return self._context
+
+        context = super().saved()
+        self.journal.unlink(missing_ok=True)
+        self._pending = []
+        return context
+
+    def rewind(self, index: int) -> None:
+        """
+        Forgets items processed after the last journal record before `index`,
+        iteration continues from there. Items compacted into the snapshot
+        can't be forgotten one by one, then iteration starts over.
+        """
+        snapshot = 0
+        if self.filename.exists():
+            with self.filename.open("rb") as fd:
+                snapshot = pickle.load(fd)[0]
+
+        if snapshot > index:
+            self.filename.unlink()
+            self.journal.unlink(missing_ok=True)
+        elif self.journal.exists():
+
+            def dump(records: list, fd: BinaryIO) -> None:
+                for record in records:
+                    pickle.dump(record, fd)
+
+            dump_atomic(
+                self.journal, [r for r in self._records() if r[0] <= index], dump
+            )
+
+        self._context = copy.deepcopy(self._initial)
+        self._pending = []
+        self._restore()
+
+
+class Shard(indexed):
+    """
+    Range of `sharded` iteration claimed by this process: yields and saves
+    global indices, the claim is released on exit
+    """
+
+    def __init__(
+        self,
+        filename: Path,
+        sequence: Sequence,
+        start: int,
+        stop: int,
+        lock: TextIO,
+        once_in: Optional[int] = None,
+        initializer: Optional[Any] = None,
+    ) -> None:
+        self.sequence = sequence
+        self.start = start
+        self.lock = lock
+        super().__init__(filename, range(start, stop), once_in, initializer)
+
+    def __next__(self) -> tuple[int, Any, Any]:
+        _, index, context = super().__next__()
+        return index, self.sequence[index], context
+
+    def save(self, index: int, context: Any) -> Any:
+        return super().save(index - self.start, context)
+
+    def __enter__(self) -> "Shard":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.lock.close()  # releases the lock
+
+
+class sharded:
+    """
+    Resumable iteration over `sequence` by several processes.
+
+    Indices are split into shards of `shard_size`, each one is an `indexed`
+    checkpoint in `directory`. A process claims a shard by locking its file.
+    The system releases the lock when the process exits, so a shard
+    of a crashed process is taken over and resumed by another one.
+    Contexts of shards start from `initializer` and are combined by `merged`.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        sequence: Sequence,
+        shard_size: int,
+        once_in: Optional[int] = None,
+        initializer: Optional[Any] = None,
+    ) -> None:
+        self.directory = directory
+        self.sequence = sequence
+        self.shard_size = shard_size
+        self.once_in = once_in
+        self.initializer = initializer
+        self.shards = range(0, len(sequence), shard_size)
+
+        directory.mkdir(parents=True, exist_ok=True)
+        layout = Singular(directory.joinpath(".layout"))
+        expected = (len(sequence), shard_size)
+        if (saved := layout.saved()) is None:
+            layout.save(expected)
+        elif saved != expected:
+            raise ValueError(
+                f"{directory} has shards of {saved[1]} out of {saved[0]} items"
+            )
+
+    def _filename(self, start: int) -> Path:
+        return self.directory.joinpath(f"shard-{start}")
+
+    def _saved(self, start: int) -> Optional[tuple[int, Any]]:
+        filename = self._filename(start)
+        if not filename.exists():
+            return None
+        with filename.open("rb") as fd:
+            index, context, _ = pickle.load(fd)
+        return index, context
+
+    def _done(self, start: int) -> bool:
+        saved = self._saved(start)
+        return saved is not None and start + saved[0] >= self._stop(start)
+
+    def _stop(self, start: int) -> int:
+        return min(start + self.shard_size, len(self.sequence))
+
+    def pending(self) -> list[int]:
+        """
+        First indices of shards which are not done
+        """
+        return [start for start in self.shards if not self._done(start)]
+
+    def claim(self) -> Optional[Shard]:
+        """
+        First pending shard not claimed by other processes
+        """
+        for start in self.pending():
+            lock = self._filename(start).with_suffix(".lock").open("a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+
+            if self._done(start):  # finished before the lock was taken
+                lock.close()
+                continue
+
+            with trace.span("checkpoint.claim", shard=start):
+                return Shard(
+                    self._filename(start),
+                    self.sequence,
+                    start,
+                    self._stop(start),
+                    lock,
+                    self.once_in,
+                    copy.deepcopy(self.initializer),
+                )
+        return None
+
+    def claims(self, poll: float = 1.0) -> Iterator[Shard]:
+        """
+        Claims shards one by one until all are done. Shards claimed by others
+        are waited for, each `poll` seconds, so they are taken over if the
+        process crashes. Each shard must be finished with `saved`.
+        """
+        while self.pending():
+            if (shard := self.claim()) is None:
+                time.sleep(poll)
+                continue
+            with shard:
+                yield shard
+
+    def merged(self, combine: Callable[[Any, Any], Any]) -> Any:
+        """
+        Contexts of all shards in order, combined
+        """
+        contexts = []
+        for start in self.shards:
+            if not self._done(start):
+                raise RuntimeError(f"Shard {start} of {self.directory} isn't done")
+            contexts.append(self._saved(start)[1])  # type: ignore[index]
+        return functools.reduce(combine, contexts, copy.deepcopy(self.initializer))
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import json
+import mmap
+import struct
+from array import array
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, BinaryIO, Iterable, NamedTuple, Sequence, overload
+
+if TYPE_CHECKING:
+    from unstructured.documents.elements import Element
+
+VERSION = 2
+MAGIC = b"ULMCOLS\n"
+
+
+def _vertical_position(e: Element) -> float:
+    """
+    Center of the element from 0 (bottom) to 1 (top of the page), -1 if unknown
+    """
+    coordinates = e.metadata.coordinates
+    if coordinates is None or coordinates.system is None or not coordinates.points:
+        return -1.0
+
+    ys = [coordinates.system.convert_to_relative(x, y)[1] for x, y in coordinates.points]
+    return (min(ys) + max(ys)) / 2
+
+
+class Row(NamedTuple):
+    text: str
+    category: str
+    page: int
+    element_id: str
+    y: float
+
+    def to_dict(self) -> dict:
+        return {
+            "type": self.category,
+            "element_id": self.element_id,
+            "metadata": {} if self.page < 0 else {"page_number": self.page},
+            "text": self.text,
+        }
+
+
+def _row(e: Element | Row) -> Row:
+    if isinstance(e, Row):
+        return e
+
+    return Row(
+        text=e.text,
+        category=e.category,
+        page=e.metadata.page_number or -1,
+        element_id=str(e.id),
+        y=_vertical_position(e),
+    )
+
+
+class Columns(Sequence[Row]):
+    """
+    Partitioned elements stored column by column in one memory-mapped file:
+    texts and ids are concatenated into buffers indexed by offset arrays,
+    categories, pages and vertical positions are plain arrays.
+    """
+
+    def __init__(self, buffer: Any) -> None:
+        self.buffer = buffer
+        (size,) = struct.unpack_from("<q", buffer, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(bytes(buffer[start : start + size]))
+        start += size  # sections follow the header
+        self.categories: list[str] = header["categories"]
+        self.columns = {
+            name: memoryview(buffer)[start + offset : start + offset + length].cast(
+                typecode
+            )
+            for name, (offset, length, typecode) in header["columns"].items()
+        }
+        self._length = len(self.columns["category"])
+
+    @classmethod
+    def load(cls, fd: BinaryIO) -> "Columns":
+        buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{fd.name} is not a columnar elements file")
+        return cls(buffer)
+
+    @classmethod
+    def open(cls, filename: Path) -> "Columns":
+        with filename.open("rb") as fd:
+            return cls.load(fd)
+
+    @staticmethod
+    def dump(elements: Iterable[Element | Row], fd: BinaryIO) -> None:
+        texts, ids = bytearray(), bytearray()
+        text_offsets, id_offsets = array("q", [0]), array("q", [0])
+        categories: dict[str, int] = {}
+        category, page, y = array("B"), array("i"), array("f")
+        for e in map(_row, elements):
+            texts += e.text.encode()
+            text_offsets.append(len(texts))
+            ids += e.element_id.encode()
+            id_offsets.append(len(ids))
+            category.append(categories.setdefault(e.category, len(categories)))
+            page.append(e.page)
+            y.append(e.y)
+
+        sections: dict[str, tuple[bytearray | array[Any], str]] = {
+            "text": (texts, "B"),
+            "text_offsets": (text_offsets, "q"),
+            "id": (ids, "B"),
+            "id_offsets": (id_offsets, "q"),
+            "category": (category, "B"),
+            "page": (page, "i"),
+            "y": (y, "f"),
+        }
+        columns, data, offset = {}, [], 0
+        for name, (section, typecode) in sections.items():
+            raw = bytes(section)
+            columns[name] = [offset, len(raw), typecode]
+            padding = -len(raw) % 8  # keep arrays aligned
+            data.append(raw + b"\0" * padding)
+            offset += len(raw) + padding
+
+        header = json.dumps(
+            {"categories": list(categories), "columns": columns}
+        ).encode()
+        header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        fd.write(MAGIC)
+        fd.write(struct.pack("<q", len(header)))
+        fd.write(header)
+        fd.writelines(data)
+
+    def __len__(self) -> int:
+        return self._length
+
+    @overload
+    def __getitem__(self, index: int) -> Row:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "Selection":
+        ...
+
+    def __getitem__(self, index: int | slice) -> "Row | Selection":
+        if isinstance(index, slice):
+            return self.take(range(len(self))[index])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        return Row(
+            text=self.text(index),
+            category=self.category(index),
+            page=self.columns["page"][index],
+            element_id=self._slice("id", index),
+            y=self.columns["y"][index],
+        )
+
+    def _slice(self, name: str, index: int) -> str:
+        offsets = self.columns[f"{name}_offsets"]
+        return bytes(self.columns[name][offsets[index] : offsets[index + 1]]).decode()
+
+    def text(self, index: int) -> str:
+        return self._slice("text", index)
+
+    def category(self, index: int) -> str:
+        return self.categories[self.columns["category"][index]]
+
+    def take(self, indices: Iterable[int]) -> "Selection":
+        return Selection(self, array("q", indices))
+
+
+class Selection(Sequence[Row]):
+    """
+    Subset of elements, which keeps only indices
+    """
+
+    def __init__(self, columns: Columns, indices: array) -> None:
+        self.columns = columns
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index: int) -> Row:  # type: ignore[override]
+        return self.columns[self.indices[index]]
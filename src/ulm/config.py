@@ -0,0 +1,27 @@
+import functools
+import os
+from pathlib import Path
+
+
+@functools.cache
+def _load() -> None:
+    import dotenv
+
+    dotenv.load_dotenv()
+
+
+def get(name: str, default: str) -> str:
+    """
+    Setting from environment or `.env` file, which is read on first use
+    """
+    _load()
+    return os.environ.get(name, default)
+
+
+def require(name: str) -> str:
+    _load()
+    return os.environ[name]
+
+
+def cache_dir() -> Path:
+    return Path(get("ULM_CACHE", str(Path.home().joinpath(".cache", "ulm"))))
@@ -0,0 +1,227 @@
+import asyncio
+import functools
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import ulm.config as config
+import ulm.trace as trace
+
+
+class TokenBucket:
+    """
+    Allows `per_minute` units per minute, refilled continuously.
+    Balance may go negative: the caller waits until it's paid off.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(
+            self.capacity,
+            self.available + (now - self.updated) * self.capacity / 60,
+        )
+        self.updated = now
+
+    def take(self, amount: float) -> float:
+        """
+        Reserves `amount`, returns seconds to wait before using it
+        """
+        with self.lock:
+            self._refill()
+            self.available -= amount
+            return max(0.0, -self.available * 60 / self.capacity)
+
+    def update(self, limit: Optional[float], remaining: Optional[float]) -> None:
+        """
+        Corrects the bucket with the limits reported by the server
+        """
+        with self.lock:
+            self._refill()
+            if limit:
+                self.capacity = limit
+            if remaining is not None:
+                self.available = min(self.available, remaining)
+
+
+def _seconds(duration: str) -> float:
+    """
+    Parses durations like `1s`, `6m0s` or `20ms`
+    """
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(value) * units[unit]
+        for value, unit in re.findall(r"([0-9.]+)(ms|s|m|h)", duration)
+    )
+
+
+class RetryableError(Exception):
+    def __init__(self, response: Optional[requests.Response], cause: Exception) -> None:
+        super().__init__(str(cause))
+        self.response = response
+        self.cause = cause
+
+
+class LLM:
+    """
+    OpenAI API client shared by the whole process: pooled connections,
+    token bucket scheduling by requests and tokens per minute,
+    retries with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.openai.com/v1",
+        requests_per_minute: float = 3500,
+        tokens_per_minute: float = 90000,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+        pool_size: int = 16,
+        timeout: float = 600,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    @staticmethod
+    def estimate_tokens(payload: dict) -> int:
+        """
+        Rough number of tokens counted against the limit: ~4 characters per token
+        """
+        prompt = payload.get("prompt") or json.dumps(payload.get("messages", ""))
+        return len(prompt) // 4 + payload.get("max_tokens", 256)
+
+    def _schedule(self, payload: dict) -> float:
+        return max(self.requests.take(1), self.tokens.take(self.estimate_tokens(payload)))
+
+    def _post(self, path: str, payload: dict) -> dict:
+        try:
+            response = self.session.post(
+                self.base_url + path, json=payload, timeout=self.timeout
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(None, e)
+
+        headers = response.headers
+        for bucket, kind in [(self.requests, "requests"), (self.tokens, "tokens")]:
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            bucket.update(
+                float(limit) if limit else None,
+                float(remaining) if remaining else None,
+            )
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            if response.status_code == 429 or response.status_code >= 500:
+                raise RetryableError(response, e)
+            raise
+        return response.json()
+
+    def _retry_delay(self, attempt: int, error: RetryableError) -> float:
+        """
+        Exponential backoff, but not shorter than the server asks to wait:
+        `retry-after` or reset of the exhausted limit. Jitter spreads retries
+        of clients limited at the same time.
+        """
+        backoff = self.backoff * 2**attempt
+        delay = 0.0
+        if error.response is not None:
+            headers = error.response.headers
+            exhausted = (
+                "tokens"
+                if headers.get("x-ratelimit-remaining-tokens") == "0"
+                else "requests"
+            )
+            if retry_after := headers.get("retry-after"):
+                delay = float(retry_after)
+            elif reset := headers.get(f"x-ratelimit-reset-{exhausted}"):
+                delay = _seconds(reset)
+        return max(delay, backoff) + random.uniform(0, backoff)
+
+    @staticmethod
+    def _usage(span: dict, response: dict) -> dict:
+        usage = response.get("usage") or {}
+        span["prompt_tokens"] = usage.get("prompt_tokens", 0)
+        span["completion_tokens"] = usage.get("completion_tokens", 0)
+        return response
+
+    def request(self, path: str, payload: dict) -> dict:
+        with trace.span("llm" + path, model=payload.get("model")) as span:
+            attempt = 0
+            while True:
+                time.sleep(delay := self._schedule(payload))
+                span["waited"] = span.get("waited", 0) + delay
+                try:
+                    return self._usage(span, self._post(path, payload))
+                except RetryableError as e:
+                    if attempt == self.max_retries:
+                        raise e.cause
+                    time.sleep(delay := self._retry_delay(attempt, e))
+                    span["waited"] += delay
+                    attempt += 1
+                    span["retries"] = attempt
+
+    async def arequest(self, path: str, payload: dict) -> dict:
+        with trace.span("llm" + path, model=payload.get("model")) as span:
+            attempt = 0
+            while True:
+                await asyncio.sleep(delay := self._schedule(payload))
+                span["waited"] = span.get("waited", 0) + delay
+                try:
+                    response = await asyncio.to_thread(self._post, path, payload)
+                    return self._usage(span, response)
+                except RetryableError as e:
+                    if attempt == self.max_retries:
+                        raise e.cause
+                    await asyncio.sleep(delay := self._retry_delay(attempt, e))
+                    span["waited"] += delay
+                    attempt += 1
+                    span["retries"] = attempt
+
+    def completion(self, **payload: Any) -> dict:
+        return self.request("/completions", payload)
+
+    def chat(self, **payload: Any) -> dict:
+        return self.request("/chat/completions", payload)
+
+    async def acompletion(self, **payload: Any) -> dict:
+        return await self.arequest("/completions", payload)
+
+    async def achat(self, **payload: Any) -> dict:
+        return await self.arequest("/chat/completions", payload)
+
+
+@functools.cache
+def client() -> LLM:
+    """
+    Client configured from environment
+    """
+    return LLM(
+        api_key=config.require("OPENAI_API_KEY"),
+        base_url=config.get("OPENAI_API_BASE", "https://api.openai.com/v1"),
+        requests_per_minute=float(config.get("OPENAI_RPM", "3500")),
+        tokens_per_minute=float(config.get("OPENAI_TPM", "90000")),
+    )
@@ -1,19 +1,55 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import itertools
 import json
+import operator
 import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from collections import deque
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from textwrap import dedent
 from pathlib import Path
+from queue import Empty, Queue
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    cast,
+)
 
-import openai
-import chromadb
 import click
-from unstructured.partition.pdf import partition_pdf
-from unstructured.partition.text import (
-    Text,
-    element_from_text,
-)
-from unstructured.cleaners.core import clean_ligatures, clean_extra_whitespace
 
 import ulm.checkpoint as checkpoint
+import ulm.config as config
+import ulm.llm as llm
+import ulm.trace as trace
+from ulm.columns import VERSION as COLUMNS_VERSION, Columns, Row
+from ulm.server import ADDRESS_FILE, AskServer, ask_server
+
+if TYPE_CHECKING:  # heavy modules are imported by commands which need them
+    import chromadb
+    import numpy as np
+    import tiktoken
+    from chromadb.api.types import EmbeddingFunction
+    from unstructured.partition.text import Text
+
+    from ulm.vectors import Retriever
 
 
 def root(filename: Path) -> Path:
@@ -22,7 +58,15 @@ def root(filename: Path) -> Path:
     return rootdir
 
 
-def confirmed(decision: bool, prompt: str, *items: str) -> bool:
+def store() -> checkpoint.Store:
+    return checkpoint.Store(config.cache_dir())
+
+
+def unattended(decision: bool, prompt: str, *items: str, **context: Any) -> bool:
+    return decision
+
+
+def confirmed(decision: bool, prompt: str, *items: str, **context: Any) -> bool:
     if not decision:
         return decision
 
@@ -31,207 +75,1467 @@ def confirmed(decision: bool, prompt: str, *items: str) -> bool:
     return click.confirm(prompt, default=decision)
 
 
-def pdf_to_elements(filename: Path) -> list[Text]:
-    rootdir = root(filename)
+class Review:
+    """
+    Decisions left for an operator, one JSON object per line: the question,
+    decision `applied` by the pipeline and `answer` to be set offline
+    to true or false. Entries are addressed by `key`.
+    """
 
-    with checkpoint.singular(filename=rootdir.joinpath("elements")) as cp:
-        if not (elements := cp.saved()):
-            elements = partition_pdf(filename, strategy="hi_res")
-            clean_hyphen = lambda s: s.replace("- ", "")
-            remove_cid = lambda s: re.sub(r"\(cid:[0-9]+\)", "", s)
-            for e in elements:
-                e.apply(
-                    clean_ligatures, clean_hyphen, clean_extra_whitespace, remove_cid
-                )
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self.entries: dict[str, dict] = {}
+        if filename.exists():
+            with filename.open() as fd:
+                for line in fd:
+                    entry = json.loads(line)
+                    self.entries[entry["key"]] = entry
 
-            elements = cp.save(elements)
-
-    with checkpoint.singular(filename=rootdir.joinpath("filtered")) as cp:
-        if not (filtered := cp.saved()):
-            filtered = cp.save(
-                list(
-                    filter(
-                        lambda e: not confirmed(
-                            is_garbage(e)[0], "Is this snippet an artifact?", e.text
-                        ),
-                        elements,
-                    )
-                )
+    def pending(self) -> list[dict]:
+        return [e for e in self.entries.values() if e["answer"] is None]
+
+    def save(self) -> None:
+        checkpoint.dump_atomic(
+            self.filename,
+            self.entries.values(),
+            lambda entries, fd: fd.writelines(
+                json.dumps(e, ensure_ascii=False).encode() + b"\n" for e in entries
+            ),
+        )
+
+
+class Policy:
+    """
+    Non-interactive replacement for `confirmed`: takes decisions with
+    confidence of at least `threshold`, others are taken provisionally
+    and put into `review`. Answers from `review` override decisions.
+    """
+
+    def __init__(self, review: Review, threshold: float = 0.8) -> None:
+        self.review = review
+        self.threshold = threshold
+
+    def __call__(
+        self,
+        decision: bool,
+        prompt: str,
+        *items: str,
+        key: str = "",
+        confidence: float = 1.0,
+        position: int = -1,
+    ) -> bool:
+        if not decision:
+            return decision  # as `confirmed`, which asks only to confirm
+
+        entry = self.review.entries.get(key)
+        if entry is None:
+            if confidence >= self.threshold:
+                return decision
+            entry = self.review.entries[key] = {
+                "key": key,
+                "prompt": prompt,
+                "items": list(items),
+                "confidence": confidence,
+                "answer": None,
+            }
+        entry["position"] = position
+        entry["applied"] = decision if entry["answer"] is None else entry["answer"]
+        return entry["applied"]
+
+    def answers(self, kind: str) -> str:
+        """
+        Fingerprint of answers to decisions of `kind`
+        """
+        answered = sorted(
+            (key, entry["answer"])
+            for key, entry in self.review.entries.items()
+            if key.startswith(kind + ":") and entry["answer"] is not None
+        )
+        return hashlib.sha256(repr((self.threshold, answered)).encode()).hexdigest()
+
+    def changed(self, *kinds: str) -> Optional[int]:
+        """
+        First position where an answer differs from the applied decision
+        """
+        positions = [
+            entry["position"]
+            for key, entry in self.review.entries.items()
+            if key.split(":")[0] in kinds
+            and entry["answer"] is not None
+            and entry["answer"] != entry.get("applied")
+        ]
+        return min(positions, default=None)
+
+
+def partition_pages(
+    filename: Path, first: int, last: int, destination: Path, strategy: str = "hi_res"
+) -> None:
+    """
+    Partitions pages from `first` to `last` (excluding) into columnar file
+    """
+    import pypdfium2 as pdfium
+    from unstructured.cleaners.core import clean_extra_whitespace, clean_ligatures
+    from unstructured.partition.pdf import partition_pdf
+
+    document = pdfium.PdfDocument(filename)
+    chunk = pdfium.PdfDocument.new()
+    chunk.import_pages(document, pages=list(range(first, last)))
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as fd:
+        chunk.save(fd)
+        fd.flush()
+        elements = partition_pdf(fd.name, strategy=strategy)
+
+    clean_hyphen = lambda s: s.replace("- ", "")
+    remove_cid = lambda s: re.sub(r"\(cid:[0-9]+\)", "", s)
+    for e in elements:
+        e.apply(clean_ligatures, clean_hyphen, clean_extra_whitespace, remove_cid)
+        if e.metadata.page_number is not None:
+            e.metadata.page_number += first
+
+    with checkpoint.singular(destination, dump=Columns.dump) as cp:
+        cp.save(elements)
+
+
+def partition_chunks(
+    filename: Path,
+    digest: str,
+    cache: checkpoint.Store,
+    pages: int,
+    workers: Optional[int],
+    strategy: str = "hi_res",
+) -> list[Columns]:
+    """
+    Partitions PDF by ranges of `pages` pages in parallel processes.
+    Every range is cached on its own, so restart redoes only unfinished ones.
+    """
+    return [
+        chunk
+        for _, chunk in partition_stream(
+            filename, digest, cache, pages, workers, strategy
+        )
+    ]
+
+
+def partition_stream(
+    filename: Path,
+    digest: str,
+    cache: checkpoint.Store,
+    pages: int,
+    workers: Optional[int],
+    strategy: str = "hi_res",
+) -> Iterator[tuple[int, Columns]]:
+    """
+    Same as `partition_chunks`, but yields first page and elements of every
+    range in page order as soon as the range is partitioned
+    """
+    import pypdfium2 as pdfium
+
+    total = len(pdfium.PdfDocument(filename))
+    chunks: list[tuple[int, Path]] = []
+    pending: list[tuple[int, int, Path]] = []
+    for first in range(0, total, pages):
+        last = min(first + pages, total)
+        with checkpoint.memoized(
+            cache,
+            digest,
+            "pages",
+            first,
+            last,
+            strategy=strategy,
+            format=COLUMNS_VERSION,
+            load=Columns.load,
+        ) as cp:
+            if cp.saved() is None:
+                pending.append((first, last, cp.filename))
+            chunks.append((first, cp.filename))
+
+    if len(pending) == 1:
+        partition_pages(filename, *pending[0], strategy)
+        pending = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            chunk: executor.submit(
+                partition_pages, filename, first, last, chunk, strategy
+            )
+            for first, last, chunk in pending
+        }
+        for first, chunk in chunks:
+            if chunk in futures:
+                futures[chunk].result()
+            yield first, Columns.open(chunk)
+
+
+def pdf_to_elements(
+    filename: Path,
+    batch_size: int = 20,
+    concurrency: int = 4,
+    pages: int = 20,
+    workers: Optional[int] = None,
+    strategy: str = "hi_res",
+    threshold: Optional[float] = None,
+    review: Optional[Path] = None,
+) -> list[dict]:
+    """
+    Elements of PDF without artifacts, with split paragraphs merged.
+
+    Decisions are confirmed interactively, or with `threshold` taken by
+    `Policy`, which leaves uncertain ones in `review` file. Answers from the
+    file are applied on the next run, redoing only the merge after the first
+    changed decision.
+    """
+    rootdir = root(filename)
+    cache = store()
+    digest = checkpoint.digest(filename)
+    policy = None
+    if threshold is not None:
+        review = review or rootdir.joinpath(f"review-{digest[:16]}.jsonl")
+        policy = Policy(Review(review), threshold)
+    confirm = confirmed if policy is None else policy
+    elements = document_elements(filename, digest, pages, workers, strategy)
+
+    params: dict[str, Any] = {
+        "model": GARBAGE_MODEL,
+        "prompt": GARBAGE_PROMPT,
+        "format": COLUMNS_VERSION,
+        "strategy": strategy,
+    }
+    answers: dict[str, Any] = {}
+    if policy is not None:
+        answers["answers"] = policy.answers("artifact")
+    with checkpoint.memoized(cache, digest, "filtered", **params, **answers) as memo:
+        if (kept := memo.saved()) is None:
+            known = Verdicts(cache.directory.joinpath(".verdicts"))
+            shards = shards_directory(filename, digest, strategy)
+            kept = filter_elements(
+                elements, batch_size, concurrency, known, confirm, shards
             )
+            if policy is not None:  # the memo hit won't ask for its decisions
+                policy.review.save()
+            memo.save(kept)
+    filtered = elements.take(kept)
 
     max_index = len(filtered) - 1
 
-    cp = checkpoint.indexed(
-        filename=rootdir.joinpath("merged"),
+    # without answers: `rewind_merge` redoes only the merge after changed ones
+    key = cache.filename(digest, "filtered", threshold=threshold, **params).name
+    once_in = 5
+    cp = checkpoint.journaled(
+        filename=rootdir.joinpath(f"merged-{key[:16]}"),
         iterable=filtered,
+        apply=extend_merged,
         initializer=([], set()),
-        once_in=5,
+        once_in=once_in,
+    )
+    if policy is not None:
+        rewind_merge(cp, policy, rootdir.joinpath(f"kept-{key[:16]}"), kept)
+
+    def save(index: int, delta: Merged) -> None:
+        if policy is not None and (index + 1) % once_in == 0:
+            policy.review.save()  # with the journal, which won't ask again
+        cp.save(index, delta)
+
+    with trace.span("merge", elements=len(filtered)):
+        for index, element, (processed, skip_indices) in cp:
+            if index in skip_indices:
+                continue
+
+            if (
+                element.category == "Title"
+                or element.text.endswith(".")
+                or index == max_index
+            ):
+                save(index, ([(kept[index],)], set()))
+            else:
+                merged: list[tuple[int, ...]] = []
+                skipped: set[int] = set()
+                max_delta = min(max_index - index, 3)
+                for candidate_index in range(index + 1, index + max_delta):
+                    candidate = filtered[candidate_index]
+                    pair = f"{element.element_id}:{candidate.element_id}"
+                    confidence = merge_confidence(element, candidate)
+                    if confirm(
+                        needs_merge(element, candidate),
+                        "Does it need merge?",
+                        element.text,
+                        candidate.text,
+                        key=f"merge:{pair}",
+                        confidence=confidence,
+                        position=index,
+                    ):
+                        merged.append((kept[index], kept[candidate_index]))
+                        if confirm(
+                            True,
+                            "Can we drop this snippet?",
+                            candidate.text,
+                            key=f"drop:{pair}",
+                            confidence=confidence,
+                            position=index,
+                        ):
+                            skipped.add(candidate_index)
+
+                        break
+
+                save(index, (merged, skipped))
+        else:
+            processed, _ = cp.saved(compact=policy is None)
+
+    if policy is not None:
+        policy.review.save()
+        if pending := policy.review.pending():
+            click.echo(f"{len(pending)} decisions wait for review in {review}")
+
+    with trace.span("records", records=len(processed)):
+        return [to_record(elements, indices) for indices in processed]
+
+
+def document_elements(
+    filename: Path,
+    digest: str,
+    pages: int = 20,
+    workers: Optional[int] = None,
+    strategy: str = "hi_res",
+) -> Columns:
+    """
+    Partitioned elements of PDF, memoized
+    """
+    with checkpoint.memoized(
+        store(),
+        digest,
+        "elements",
+        strategy=strategy,
+        format=COLUMNS_VERSION,
+        load=Columns.load,
+        dump=Columns.dump,
+    ) as cp:
+        if not (elements := cp.saved()):
+            with trace.span("partition", strategy=strategy):
+                chunks = partition_chunks(
+                    filename, digest, cp.store, pages, workers, strategy
+                )
+                cp.save(row for chunk in chunks for row in chunk)
+            elements = Columns.open(cp.filename)
+    return elements
+
+
+def shards_directory(filename: Path, digest: str, strategy: str) -> Path:
+    """
+    Shards of `is_garbage` classification shared by `preprocess` and `classify`
+    """
+    key = store().filename(
+        digest,
+        "classified",
+        strategy=strategy,
+        model=GARBAGE_MODEL,
+        prompt=GARBAGE_PROMPT,
+        format=COLUMNS_VERSION,
     )
-    for index, element, (processed, skip_indices) in cp:
-        if index in skip_indices:
+    return root(filename).joinpath(f"classified-{key.name[:16]}")
+
+
+def rewind_merge(
+    cp: checkpoint.journaled, policy: Policy, previous: Path, kept: array
+) -> None:
+    """
+    Redoes the merge from the first element affected by changed answers:
+    either the filter kept other elements or a merge decision has changed
+    """
+    rewind = policy.changed("merge", "drop")
+    with checkpoint.singular(previous) as kept_cp:
+        if (old := kept_cp.saved()) != kept:
+            old = old or array("q")
+            diverged = next(
+                (i for i, (a, b) in enumerate(zip(old, kept)) if a != b),
+                min(len(old), len(kept)),
+            )
+            diverged = max(diverged - 2, 0)  # merge looks two elements ahead
+            rewind = diverged if rewind is None else min(rewind, diverged)
+        if rewind is not None:
+            cp.rewind(rewind)
+        kept_cp.save(kept)
+
+
+def filter_elements(
+    elements: Columns,
+    batch_size: int,
+    concurrency: int,
+    known: Verdicts,
+    confirm: Callable[..., bool] = confirmed,
+    shards: Optional[Path] = None,
+) -> array:
+    """
+    Indices of elements which are not artifacts:
+    decided by layout, then by LLM and confirmed with `confirm`.
+    With `shards` LLM classification is shared with other processes.
+    """
+    with trace.span("filter.layout", elements=len(elements)):
+        decided = layout_verdicts(elements)
+    ambiguous = [index for index, v in enumerate(decided) if v is None]
+    with trace.span("filter.classify", snippets=len(ambiguous)):
+        if shards is None:
+            verdicts = classify_garbage(
+                elements.take(ambiguous), batch_size, concurrency, known
+            )
+        else:
+            verdicts = classify_shared(
+                elements.take(ambiguous), shards, batch_size, concurrency, known
+            )
+    click.echo(
+        f"Layout: {len(decided) - len(ambiguous)} decided, {len(ambiguous)} left."
+        f" Verdicts: {known.hits} known, {known.misses} new"
+        f" (hit rate {known.hit_rate():.0%})"
+    )
+    with trace.span("filter.confirm"):
+        for index, (garbage, explanation) in zip(ambiguous, verdicts):
+            text = elements.text(index)
+            decided[index] = (
+                confirm(
+                    garbage,
+                    "Is this snippet an artifact?",
+                    text,
+                    key=f"artifact:{known.key(text)}",
+                    confidence=verdict_confidence(explanation),
+                    position=index,
+                ),
+                "",
+            )
+    return array("q", (i for i, v in enumerate(decided) if v and not v[0]))
+
+
+Merged = tuple[list[tuple[int, ...]], set[int]]
+
+
+def extend_merged(context: Merged, delta: Merged) -> Merged:
+    processed, skip_indices = context
+    processed.extend(delta[0])
+    skip_indices.update(delta[1])
+    return processed, skip_indices
+
+
+def to_record(elements: Columns, indices: tuple[int, ...]) -> dict:
+    """
+    Element as a dictionary, merging text of several elements if needed
+    """
+    if len(indices) == 1:
+        return elements[indices[0]].to_dict()
+
+    return merged_record([elements.text(index) for index in indices])
+
+
+def merged_record(texts: Sequence[str]) -> dict:
+    from unstructured.partition.text import element_from_text
+
+    first, *rest = texts
+    sep = "" if first.endswith(" ") else " "
+    return element_from_text(sep.join([first, *rest])).to_dict()
+
+
+def merge_stream(
+    rows: Iterable[Row], confirm: Callable[..., bool] = confirmed
+) -> Iterator[dict]:
+    """
+    Records of the merge stage of `pdf_to_elements` over a stream of elements,
+    keeping only the two elements it looks ahead at
+    """
+    window: deque[Row] = deque()
+    skipped: set[int] = set()
+    rows = iter(rows)
+    for index in itertools.count():
+        window.extend(itertools.islice(rows, 4 - len(window)))
+        if not window:
+            return
+        element = window[0]
+        if index in skipped:
+            window.popleft()
             continue
 
-        if (
-            element.category == "Title"
-            or element.text.endswith(".")
-            or index == max_index
-        ):
-            processed.append(element)
-            cp.save(index, (processed, skip_indices))
+        if element.category == "Title" or element.text.endswith(".") or len(window) == 1:
+            yield element.to_dict()
         else:
-            max_delta = min(max_index - index, 3)
-            for candidate_index in range(index + 1, index + max_delta):
-                if confirmed(
-                    needs_merge(element, filtered[candidate_index]),
+            for delta in range(1, min(len(window) - 1, 3)):
+                candidate = window[delta]
+                pair = f"{element.element_id}:{candidate.element_id}"
+                confidence = merge_confidence(element, candidate)
+                if confirm(
+                    needs_merge(element, candidate),
                     "Does it need merge?",
                     element.text,
-                    filtered[candidate_index].text,
+                    candidate.text,
+                    key=f"merge:{pair}",
+                    confidence=confidence,
                 ):
-                    sep = "" if element.text.endswith(" ") else " "
-                    processed.append(
-                        element_from_text(
-                            sep.join([element.text, filtered[candidate_index].text])
-                        )
-                    )
-                    if confirmed(
+                    yield merged_record([element.text, candidate.text])
+                    if confirm(
                         True,
                         "Can we drop this snippet?",
-                        filtered[candidate_index].text,
+                        candidate.text,
+                        key=f"drop:{pair}",
+                        confidence=confidence,
                     ):
-                        skip_indices.add(candidate_index)
-
+                        skipped.add(index + delta)
                     break
+        window.popleft()
 
-            cp.save(index, (processed, skip_indices))
-    else:
-        processed, _ = cp.saved()
 
-    return processed
+def merge_confidence(e1: Text | Row, e2: Text | Row) -> float:
+    """
+    Confidence of `needs_merge`: text continued in lowercase
+    or after a hyphen or comma is almost certainly one paragraph
+    """
+    if e2.text[:1].islower() or e1.text.rstrip().endswith(("-", ",")):
+        return 0.9
+    return 0.6
 
 
-def needs_merge(e1: Text, e2: Text) -> bool:
+def needs_merge(e1: Text | Row, e2: Text | Row) -> bool:
     p2 = e2.text.split(".")[0]
-    return not e1.text.endswith(".") and len(p2) > 30, ""
+    return not e1.text.endswith(".") and len(p2) > 30
+
+
+GARBAGE_MODEL = "davinci-002"
+GARBAGE_PROMPT = "v2"  # change on any edit of the prompt below
+
+GARBAGE_INSTRUCTIONS = dedent(
+    """
+    The following text snippets are extracted from PDF version of scientific journal article on sociology.
+    Extraction software extracts all text, including page number, headers with the name of journal, extra metadata, etc.
+
+    Your task is to categorize text snippet to two categories: 'artifact' or 'meaningful'.
+    Think step by step. Then in the end of paragraph write final category.
+    If text snippet is artefact text (page number, name of the journal, metadata about file, etc.) then respond `yes`.
+    Otherwise, respond `no`. Before final desicion, provide explanation for your choice.
+    """
+)
+
+GARBAGE_EXAMPLES = [
+    (
+        "3",
+        "This is just a number. It's very likely this is page number. Page number is not part of article text. Artifact",
+    ),
+    (
+        "EPD: Society and Space 0(0)",
+        "Very short snippet of text is very likely to be an artefact. But we need to make sure this is not a part of the article. "
+        "'Society and Space' could be a name of sociology journal. Also, snippet ends with numbers in cryptic sequence, maybe its a issue number. "
+        "Overall it seems that this snippet is an artifact text from header, because header frequently has journal name or author name. Artifact",
+    ),
+    (
+        "Keywords Adaptation, infrastructure, labor, Mexico City, repair, urban modernity",
+        "This looks like Keyword section, wich is common for scientific articles. Also, no journal editor would would put keywords in the headers. Meaningful",
+    ),
+    (
+        "De Coss-Corzo",
+        "This sounds like a last name of spanish or portuguese origin. It is very likely to be author's name. "
+        "Author's name is frequently put into page header, so it very likely an artifact. Artifact",
+    ),
+]
+
+
+HEDGES = ("maybe", "might", "could", "possibly", "probably", "not sure", "unclear")
+
 
+def verdict_confidence(explanation: str) -> float:
+    """
+    Rough confidence of the model verdict: hedged explanations are less certain
+    """
+    text = explanation.lower()
+    if not text.rstrip(" .").endswith(("artifact", "meaningful")):
+        return 0.5
+    return 0.6 if any(hedge in text for hedge in HEDGES) else 0.9
 
-def is_garbage(e: Text) -> tuple[bool, str]:
+
+def is_artifact(response: str) -> bool:
+    return "artifact" in [s.strip(" ").lower() for s in response.split(".")]
+
+
+def is_garbage(e: Text | Row) -> tuple[bool, str]:
     if e.category == "NarrativeText":
         return False, "NarrativeText"
 
-    prompt = dedent(
-        f"""
-        The following text snippets are extracted from PDF version of scientific journal article on sociology.
-        Extraction software extracts all text, including page number, headers with the name of journal, extra metadata, etc.
-
-        Your task is to categorize text snippet to two categories: 'artifact' or 'meaningful'.
-        Think step by step. Then in the end of paragraph write final category.
-        If text snippet is artefact text (page number, name of the journal, metadata about file, etc.) then respond `yes`.
-        Otherwise, respond `no`. Before final desicion, provide explanation for your choice.
-
-        Examples:
-        ```
-        3
-        ```
-        This is just a number. It's very likely this is page number. Page number is not part of article text. Artifact
-        
-
-        ```
-        EPD: Society and Space 0(0)
-        ```
-        Very short snippet of text is very likely to be an artefact. But we need to make sure this is not a part of the article.
-        'Society and Space' could be a name of sociology journal. Also, snippet ends with numbers in cryptic sequence, maybe its a issue number.
-        Overall it seems that this snippet is an artifact text from header, because header frequently has journal name or author name. Artifact
-
-        ```
-        Keywords Adaptation, infrastructure, labor, Mexico City, repair, urban modernity
-        ```
-        This looks like Keyword section, wich is common for scientific articles. Also, no journal editor would would put keywords in the headers. Meaningful
-
-        ```
-        De Coss-Corzo
-        ```
-        This sounds like a last name of spanish or portuguese origin. It is very likely to be author's name.
-        Author's name is frequently put into page header, so it very likely an artifact. Artifact
-
-        ```
-        {e.text}
-        ```
-        """
+    prompt = (
+        GARBAGE_INSTRUCTIONS
+        + "\nExamples:\n"
+        + "".join(
+            f"```\n{snippet}\n```\n{explanation}\n\n"
+            for snippet, explanation in GARBAGE_EXAMPLES
+        )
+        + f"```\n{e.text}\n```\n"
     )
-    completion = openai.Completion.create(
-        model="davinci-002",
+    completion = llm.client().completion(
+        model=GARBAGE_MODEL,
         prompt=prompt,
         max_tokens=400,
         stop=["\n"],
         temperature=0,
     )
     response = completion["choices"][0]["text"]
-    return "artifact" in [s.strip(" ").lower() for s in response.split(".")], response
+    return is_artifact(response), response
+
+
+def _numbered(lines: Sequence[str]) -> str:
+    return "".join(
+        f"[{number}] {line}\n" for number, line in enumerate(lines, start=1)
+    )
+
+
+def is_garbage_batch(batch: Sequence[Text | Row]) -> list[tuple[bool, str]]:
+    """
+    Classifies several snippets with one request.
+    Snippets without a parsable answer are classified one by one.
+    """
+    quoted = lambda text: "```" + " ".join(text.split()) + "```"
+    prompt = (
+        GARBAGE_INSTRUCTIONS
+        + "Each snippet is numbered, answer for every snippet on a separate line with the same number.\n"
+        + "\nSnippets:\n"
+        + _numbered([quoted(snippet) for snippet, _ in GARBAGE_EXAMPLES])
+        + "Answers:\n"
+        + _numbered([explanation for _, explanation in GARBAGE_EXAMPLES])
+        + "\nSnippets:\n"
+        + _numbered([quoted(e.text) for e in batch])
+        + "Answers:\n"
+    )
+    completion = llm.client().completion(
+        model=GARBAGE_MODEL,
+        prompt=prompt,
+        max_tokens=150 * len(batch),
+        stop=["\nSnippets:"],
+        temperature=0,
+    )
+    answers = {
+        int(match.group(1)): match.group(2)
+        for match in re.finditer(
+            r"^\[(\d+)\] *(.*)$", completion["choices"][0]["text"], re.MULTILINE
+        )
+    }
+
+    verdicts = []
+    for number, e in enumerate(batch, start=1):
+        response = answers.get(number, "")
+        if response.rstrip(" .").lower().endswith(("artifact", "meaningful")):
+            verdicts.append((is_artifact(response), response))
+        else:
+            verdicts.append(is_garbage(e))
+    return verdicts
+
+
+def layout_verdicts(elements: Columns) -> list[Optional[tuple[bool, str]]]:
+    """
+    Decides obvious cases without LLM using page layout:
+    text repeated on many pages (running headers, journal and author names),
+    page numbers at the page edges and long unique text in the page body.
+    Undecided elements get `None`.
+    """
+    pages: dict[str, set[int]] = {}
+    for row in elements:
+        if row.page >= 0:
+            pages.setdefault(Verdicts.normalized(row.text), set()).add(row.page)
+    total = len({page for occurrences in pages.values() for page in occurrences})
+    repeated = max(3, total * 0.3)
+
+    verdicts: list[Optional[tuple[bool, str]]] = []
+    for row in elements:
+        occurrences = len(pages.get(Verdicts.normalized(row.text), ()))
+        edge = 0 <= row.y < 0.1 or row.y > 0.9
+        if row.category == "NarrativeText":
+            verdict: Optional[tuple[bool, str]] = (False, "NarrativeText")
+        elif occurrences >= repeated and len(row.text) < 200:
+            verdict = (True, f"Repeats on {occurrences} pages. Artifact")
+        elif edge and re.fullmatch(r"\W*([0-9]{1,4}|[ivxlc]+)\W*", row.text, re.I):
+            verdict = (True, "Number at the page edge. Artifact")
+        elif occurrences == 1 and 0.1 <= row.y <= 0.9 and len(row.text) >= 120:
+            verdict = (False, "Long unique text in the page body. Meaningful")
+        else:
+            verdict = None
+        verdicts.append(verdict)
+
+    return verdicts
+
+
+class Verdicts:
+    """
+    Persistent `is_garbage` verdicts shared between documents.
+    Snippets which differ only in whitespace or digits share the verdict.
+    """
+
+    def __init__(self, filename: Path) -> None:
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts"
+            " (key TEXT PRIMARY KEY, garbage INTEGER, explanation TEXT)"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalized(text: str) -> str:
+        return re.sub(r"[0-9]+", "0", " ".join(text.split()))
+
+    def key(self, text: str) -> str:
+        key = "\0".join([GARBAGE_MODEL, GARBAGE_PROMPT, self.normalized(text)])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, text: str) -> Optional[tuple[bool, str]]:
+        row = self.db.execute(
+            "SELECT garbage, explanation FROM verdicts WHERE key = ?", [self.key(text)]
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return bool(row[0]), row[1]
+
+    def put(self, text: str, verdict: tuple[bool, str]) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+                [self.key(text), *verdict],
+            )
+
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+def classify_garbage(
+    elements: Sequence[Text | Row],
+    batch_size: int = 20,
+    concurrency: int = 4,
+    cache: Optional[Verdicts] = None,
+) -> list[tuple[bool, str]]:
+    """
+    Same as `is_garbage` for every element,
+    but with batched requests sent concurrently.
+    Repeated snippets are classified once, known ones are taken from `cache`.
+    """
+    verdicts: list[tuple[bool, str]] = [(False, "NarrativeText")] * len(elements)
+    pending: dict[str, list[int]] = {}
+    for index, e in enumerate(elements):
+        if e.category == "NarrativeText":
+            continue
+        if cache is not None and (verdict := cache.get(e.text)) is not None:
+            verdicts[index] = verdict
+        else:
+            pending.setdefault(Verdicts.normalized(e.text), []).append(index)
+
+    unique = [indices[0] for indices in pending.values()]
+    batches = [
+        unique[start : start + batch_size] for start in range(0, len(unique), batch_size)
+    ]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(
+            lambda batch: is_garbage_batch([elements[i] for i in batch]), batches
+        )
+        for batch, batch_verdicts in zip(batches, results):
+            for index, verdict in zip(batch, batch_verdicts):
+                text = elements[index].text
+                for duplicate in pending[Verdicts.normalized(text)]:
+                    verdicts[duplicate] = verdict
+                if cache is not None:
+                    cache.put(text, verdict)
+
+    return verdicts
+
 
+CLASSIFY_SHARD_SIZE = 80
 
-def document_to_jsonl(pdf: str, jsonl: str) -> None:
-    elements = pdf_to_elements(filename=Path(pdf))
+
+def classify_shared(
+    elements: Sequence[Text | Row],
+    directory: Path,
+    batch_size: int = 20,
+    concurrency: int = 4,
+    cache: Optional[Verdicts] = None,
+    shard_size: int = CLASSIFY_SHARD_SIZE,
+) -> list[tuple[bool, str]]:
+    """
+    Same as `classify_garbage`, but shared by processes working in `directory`:
+    each one claims shards of `shard_size` snippets, takes over shards
+    of crashed processes and waits for the rest. Shards don't depend on
+    `batch_size` and `concurrency`, so processes may use different ones.
+    """
+    work = checkpoint.sharded(directory, elements, shard_size, initializer=[])
+    for shard in work.claims():
+        remaining = list(shard)
+        index, _, context = remaining[-1]
+        rows = [row for _, row, _ in remaining]
+        shard.save(
+            index, context + classify_garbage(rows, batch_size, concurrency, cache)
+        )
+        shard.saved()
+    return work.merged(operator.add)
+
+
+def document_to_jsonl(pdf: str, jsonl: str, **kwargs: Any) -> None:
+    elements = pdf_to_elements(filename=Path(pdf), **kwargs)
     with Path(jsonl).open("w") as fd:
         for e in elements:
-            fd.write(json.dumps(e.to_dict(), ensure_ascii=False))
+            fd.write(json.dumps(e, ensure_ascii=False))
             fd.write("\n")
 
 
+class AnswerCache:
+    """
+    Answers to earlier questions about a collection, found by cosine similarity
+    of question embeddings. Answers expire after `ttl` seconds or when the
+    collection revision changes, least recently used are evicted above
+    `max_entries`.
+    """
+
+    def __init__(
+        self,
+        filename: Path,
+        embedding_function: Callable[[list[str]], Any],
+        threshold: float = 0.95,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 10000,
+    ) -> None:
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS answers (question TEXT, answer TEXT,"
+            " embedding BLOB, revision TEXT, created REAL, used REAL)"
+        )
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def embed(self, question: str) -> np.ndarray:
+        import numpy as np
+
+        embedding = np.asarray(self.embedding_function([question])[0], dtype=np.float32)
+        return embedding / np.linalg.norm(embedding)
+
+    def get(
+        self, revision: str, embedding: np.ndarray, threshold: Optional[float] = None
+    ) -> Optional[str]:
+        import numpy as np
+
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM answers WHERE revision != ? OR created < ?",
+                [revision, time.time() - self.ttl],
+            )
+            rows = self.db.execute("SELECT rowid, embedding FROM answers").fetchall()
+            if not rows:
+                return None
+
+            matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32)
+            similarity = matrix.reshape(len(rows), -1) @ embedding
+            best = int(np.argmax(similarity))
+            if similarity[best] < (threshold or self.threshold):
+                return None
+
+            rowid = rows[best][0]
+            self.db.execute(
+                "UPDATE answers SET used = ? WHERE rowid = ?", [time.time(), rowid]
+            )
+            (answer,) = self.db.execute(
+                "SELECT answer FROM answers WHERE rowid = ?", [rowid]
+            ).fetchone()
+            return answer
+
+    def put(
+        self, revision: str, question: str, embedding: np.ndarray, answer: str
+    ) -> None:
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                [question, answer, embedding.tobytes(), revision, now, now],
+            )
+            self.db.execute(
+                "DELETE FROM answers WHERE rowid NOT IN"
+                " (SELECT rowid FROM answers ORDER BY used DESC LIMIT ?)",
+                [self.max_entries],
+            )
+
+
 class ChromaFactory:
     collection_name = "default"
 
+    @staticmethod
+    def content_hash(text: str, page: int) -> str:
+        return hashlib.sha256(f"{page}\0{text}".encode()).hexdigest()
+
     @classmethod
-    def from_jsonl(cls, jsonl: Path, destination: Path) -> chromadb.Collection:
-        client = chromadb.PersistentClient(path=str(destination))
-        client.delete_collection(cls.collection_name)
-        collection = client.create_collection(cls.collection_name)
+    def batches(cls, jsonl: Path, batch_size: int) -> Iterator[dict[str, list]]:
         with jsonl.open("r") as fd:
-            for line in fd:
-                element: dict = json.loads(line)
-                if element["type"] == "Title":
+            yield from cls.record_batches(map(json.loads, fd), batch_size)
+
+    @classmethod
+    def record_batches(
+        cls, records: Iterable[dict], batch_size: int
+    ) -> Iterator[dict[str, list]]:
+
+        def unique() -> Iterator[dict]:
+            # ids are hashes of text: the first element wins, as a repeated
+            # id is rejected by upsert and would be upserted on every upload
+            seen: set[str] = set()
+            for e in records:
+                if e["type"] != "Title" and e["element_id"] not in seen:
+                    seen.add(e["element_id"])
+                    yield e
+
+        elements = unique()
+        while batch := list(itertools.islice(elements, batch_size)):
+            yield {
+                "ids": [f"{e['element_id']}" for e in batch],
+                "documents": [e["text"] for e in batch],
+                "metadatas": [
+                    {
+                        "page": (page := e.get("metadata", {}).get("page_number", -1)),
+                        "hash": cls.content_hash(e["text"], page),
+                    }
+                    for e in batch
+                ],
+            }
+
+    @classmethod
+    def from_jsonl(
+        cls,
+        jsonl: Path,
+        destination: Path,
+        batch_size: int = 256,
+        incremental: bool = False,
+    ) -> chromadb.Collection:
+        return cls.upload(
+            cls.batches(jsonl, batch_size), destination, batch_size, incremental
+        )
+
+    @classmethod
+    def upload(
+        cls,
+        batches: Iterable[dict[str, list]],
+        destination: Path,
+        batch_size: int = 256,
+        incremental: bool = False,
+    ) -> chromadb.Collection:
+        """
+        Uploads elements by batches. Next batch is read while the previous
+        one is embedded and written, at most two batches are kept in memory.
+
+        Incremental upload keeps elements with unchanged content hash,
+        upserts changed ones and deletes ones missing in `batches`.
+        """
+        import chromadb
+        from chromadb.errors import ChromaError
+
+        client = chromadb.PersistentClient(path=str(destination))
+        if not incremental:
+            try:
+                client.delete_collection(cls.collection_name)
+            except (ValueError, ChromaError):
+                pass  # fresh database
+        collection = client.get_or_create_collection(
+            cls.collection_name, embedding_function=cls.embedding_function()
+        )
+
+        stored = collection.get(include=["metadatas"]) if incremental else None
+        known = (
+            {
+                i: m.get("hash")
+                for i, m in zip(stored["ids"], stored["metadatas"] or [])
+            }
+            if stored
+            else {}
+        )
+        seen: set[str] = set()
+        unchanged = upserted = 0
+
+        def upsert(**batch: list) -> None:
+            with trace.span("chroma.upsert", elements=len(batch["ids"])):
+                collection.upsert(**batch)
+
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending: Optional[Future] = None
+            for batch in batches:
+                seen.update(batch["ids"])
+                changed = [
+                    index
+                    for index, (i, metadata) in enumerate(
+                        zip(batch["ids"], batch["metadatas"])
+                    )
+                    if known.get(i) != metadata["hash"]
+                ]
+                unchanged += len(batch["ids"]) - len(changed)
+                upserted += len(changed)
+                if not changed:
                     continue
-                collection.add(
-                    documents=element["text"],
-                    metadatas={
-                        key: element.get("metadata", {}).get(key, -1)
-                        for key in ["page"]
-                    },
-                    ids=f"{element['element_id']}",
-                )
 
+                batch = {
+                    key: [values[index] for index in changed]
+                    for key, values in batch.items()
+                }
+                if pending is not None:
+                    pending.result()
+                pending = writer.submit(upsert, **batch)
+            if pending is not None:
+                pending.result()
+
+        if deleted := [i for i in known if i not in seen]:
+            for start in range(0, len(deleted), batch_size):
+                collection.delete(ids=deleted[start : start + batch_size])
+
+        if upserted or deleted:  # invalidates cached answers
+            collection.modify(metadata={"revision": uuid.uuid4().hex})
+        if incremental:
+            click.echo(
+                f"Unchanged: {unchanged}, upserted: {upserted}, deleted: {len(deleted)}"
+            )
         return collection
 
     @classmethod
     def from_path(cls, path: Path) -> chromadb.Collection:
+        import chromadb
+
         return chromadb.PersistentClient(path=str(path)).get_collection(
-            cls.collection_name
+            cls.collection_name, embedding_function=cls.embedding_function()
+        )
+
+    @staticmethod
+    @functools.cache
+    def embedding_function() -> EmbeddingFunction:
+        from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+
+        return DefaultEmbeddingFunction()
+
+    @classmethod
+    def storage(cls, path: Path) -> Retriever:
+        """
+        Collection of any backend stored in `path`
+        """
+        from ulm.vectors import NumpyIndex
+
+        if NumpyIndex.exists(path):
+            return NumpyIndex(path, cls.embedding_function())
+        # `Collection.query` accepts more than `Retriever` needs
+        return cast("Retriever", cls.from_path(path))
+
+    @classmethod
+    def answers(cls, path: Path, **kwargs: Any) -> AnswerCache:
+        return AnswerCache(
+            path.joinpath("answers.sqlite"), cls.embedding_function(), **kwargs
         )
 
 
-def rag_ask(storage: chromadb.Collection, question: str) -> str:
-    retrieved = storage.query(query_texts=question, n_results=5, include=["documents"])
+def staged(iterable: Iterable, maxsize: int = 2) -> Iterator:
+    """
+    Runs `iterable` in a thread at most `maxsize` items ahead of the consumer
+    """
+    queue: Queue[tuple[bool, Any]] = Queue(maxsize)
+    stopped = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    break
+                queue.put((False, item))
+            queue.put((True, None))
+        except BaseException as e:
+            queue.put((True, e))
+        finally:
+            getattr(iterable, "close", lambda: None)()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            finished, item = queue.get()
+            if finished:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()
+        while thread.is_alive():  # unblocks the producer if the queue is full
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+def ingest_pdf(
+    filename: Path,
+    destination: Path,
+    batch_size: int = 20,
+    concurrency: int = 4,
+    pages: int = 20,
+    workers: Optional[int] = None,
+    strategy: str = "hi_res",
+    upload_batch_size: int = 256,
+    confirm: Callable[..., bool] = unattended,
+) -> chromadb.Collection:
+    """
+    PDF to collection in one pass: partitioning, filtering, merging and upload
+    work at the same time on consecutive page ranges, connected by bounded
+    queues, so memory doesn't grow with the document.
+
+    Artifacts are found by layout within every page range. Restart reuses
+    partitioned and filtered ranges and doesn't embed unchanged elements again.
+    """
+    cache = store()
+    digest = checkpoint.digest(filename)
+
+    def filtered() -> Iterator[Row]:
+        # runs in the thread of `staged`, sqlite connection can't be shared
+        known = Verdicts(cache.directory.joinpath(".verdicts"))
+        chunks = partition_stream(filename, digest, cache, pages, workers, strategy)
+        for first, chunk in staged(chunks):
+            with checkpoint.memoized(
+                cache,
+                digest,
+                "filtered",
+                first,
+                pages,
+                strategy=strategy,
+                model=GARBAGE_MODEL,
+                prompt=GARBAGE_PROMPT,
+                format=COLUMNS_VERSION,
+            ) as cp:
+                if (kept := cp.saved()) is None:
+                    kept = cp.save(
+                        filter_elements(chunk, batch_size, concurrency, known, confirm)
+                    )
+            yield from chunk.take(kept)
+
+    records = staged(merge_stream(staged(filtered(), 1024), confirm), 1024)
+    batches = staged(ChromaFactory.record_batches(records, upload_batch_size))
+    return ChromaFactory.upload(
+        batches, destination, upload_batch_size, incremental=True
+    )
+
+
+def revision(storage: Retriever) -> str:
+    return (storage.metadata or {}).get("revision", "")
+
+
+class LatestStorage:
+    """
+    `ChromaFactory.storage` reopened whenever files in `path` change,
+    so a long running process sees uploads and their revision
+    """
+
+    ignored = ("answers.sqlite", ADDRESS_FILE, ".")
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp: Optional[list] = None
+        self.storage: Optional[Retriever] = None
+
+    def _stamp(self) -> list:
+        stamp = []
+        for entry in self.path.iterdir():
+            if entry.name.startswith(self.ignored):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # replaced meanwhile
+                continue
+            stamp.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        return sorted(stamp)
+
+    def get(self) -> Retriever:
+        stamp = self._stamp()
+        with self.lock:
+            if self.storage is None or stamp != self.stamp:
+                self.storage = ChromaFactory.storage(self.path)
+                self.stamp = stamp
+            return self.storage
+
+
+CHAT_MODEL = "gpt-3.5-turbo"
+RETRIEVED = 10
+CONTEXT_SEPARATOR = "\n---\n"
+
+
+@functools.cache
+def _encoding() -> tiktoken.Encoding:
+    import tiktoken
+
+    return tiktoken.encoding_for_model(CHAT_MODEL)
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding().encode(text))
+
+
+def _shingles(text: str) -> set[tuple[str, ...]]:
+    words = text.lower().split()
+    return {tuple(words[i : i + 3]) for i in range(max(len(words) - 2, 1))}
+
+
+def pack_context(
+    documents: list[str],
+    budget: int,
+    count: Optional[Callable[[str], int]] = None,
+    duplicate: float = 0.8,
+) -> list[str]:
+    """
+    Takes documents in order of relevance while they fit into `budget` tokens.
+    Skips documents which share `duplicate` of word trigrams with taken ones,
+    document which doesn't fit is cut at the sentence boundary.
+    """
+    count = count or count_tokens
+    separator = count(CONTEXT_SEPARATOR)
+    packed: list[str] = []
+    taken: list[set[tuple[str, ...]]] = []
+    used = 0
+    for document in documents:
+        shingles = _shingles(document)
+        if any(
+            len(shingles & other) / len(shingles | other) >= duplicate
+            for other in taken
+        ):
+            continue
+
+        left = budget - used - (separator if packed else 0)
+        if (tokens := count(document)) > left:
+            fitting = ""
+            for sentence in re.split(r"(?<=[.!?])\s+", document):
+                candidate = f"{fitting} {sentence}" if fitting else sentence
+                if count(candidate) > left:
+                    break
+                fitting = candidate
+            if not fitting:
+                continue
+            document, tokens = fitting, count(fitting)
+
+        packed.append(document)
+        taken.append(shingles)
+        used += tokens + (separator if len(packed) > 1 else 0)
+
+    return packed
+
+
+def rag_ask(
+    storage: Retriever,
+    question: str,
+    cache: Optional[AnswerCache] = None,
+    budget: int = 1500,
+    similarity: Optional[float] = None,
+) -> str:
+    if cache is None:
+        with trace.span("retrieve"):
+            retrieved = storage.query(
+                query_texts=question, n_results=RETRIEVED, include=["documents"]
+            )
+    else:
+        with trace.span("embed"):
+            embedding = cache.embed(question)
+        with trace.span("answers.get") as span:
+            answer = cache.get(revision(storage), embedding, similarity)
+            span["hit"] = answer is not None
+        if answer is not None:
+            return answer
+        with trace.span("retrieve"):
+            retrieved = storage.query(
+                query_embeddings=[embedding.tolist()],
+                n_results=RETRIEVED,
+                include=["documents"],
+            )
+
+    answer, usage = complete_answer(question, retrieved["documents"][0], budget)
+    click.echo(
+        f"Prompt tokens: {usage['prompt_tokens']},"
+        f" context {usage['context_tokens']} of {usage['retrieved_tokens']} retrieved",
+        err=True,
+    )
+
+    if cache is not None:
+        cache.put(revision(storage), question, embedding, answer)
+    return answer
+
+
+def complete_answer(
+    question: str, documents: list[str], budget: int = 1500
+) -> tuple[str, dict[str, int]]:
+    """
+    Answer and token counts: of the prompt, packed and retrieved context
+    """
+    with trace.span("pack_context", documents=len(documents)):
+        context = pack_context(documents, budget)
     prompt = (
         "Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.\n"
-        + "\n---\n".join(retrieved["documents"][0])
+        + CONTEXT_SEPARATOR.join(context)
         + f"\nQuestion: {question}"
     )
-    completion = openai.ChatCompletion.create(
-        messages=[{"role": "user", "content": prompt}], model="gpt-3.5-turbo"
+    completion = llm.client().chat(
+        messages=[{"role": "user", "content": prompt}], model=CHAT_MODEL
     )
+    usage = {
+        "prompt_tokens": completion.get("usage", {}).get("prompt_tokens", -1),
+        "context_tokens": count_tokens(CONTEXT_SEPARATOR.join(context)),
+        "retrieved_tokens": count_tokens(CONTEXT_SEPARATOR.join(documents)),
+    }
+    return completion["choices"][0]["message"]["content"], usage
+
+
+def rag_ask_batch(
+    storage: Retriever,
+    questions: list[dict],
+    concurrency: int = 4,
+    budget: int = 1500,
+) -> Iterator[dict]:
+    """
+    Answers questions retrieving context for all of them with one query,
+    yields results in order of completion. A failed answer has `error` instead.
+    """
+    started = time.perf_counter()
+    with trace.span("retrieve", questions=len(questions)):
+        retrieved = storage.query(
+            query_texts=[q["question"] for q in questions],
+            n_results=RETRIEVED,
+            include=["documents"],
+        )
+    retrieval = time.perf_counter() - started
 
-    return completion["choices"][0]["message"]["content"]
+    def answer(index: int) -> dict:
+        started = time.perf_counter()
+        result = {**questions[index], "ids": retrieved["ids"][index]}
+        try:
+            text, usage = complete_answer(
+                questions[index]["question"], retrieved["documents"][index], budget
+            )
+        except Exception as e:
+            result["error"] = repr(e)
+        else:
+            result.update(answer=text, **usage)
+        result["latency"] = retrieval + time.perf_counter() - started
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(answer, index) for index in range(len(questions))]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+PROFILE_HELP = "Write JSON trace of pipeline stages and print their summary"
+
+PIPELINE_OPTIONS = [
+    click.option("--batch-size", type=int, default=20, help="Snippets per LLM request"),
+    click.option("--concurrency", type=int, default=4, help="Parallel LLM requests"),
+    click.option(
+        "--pages", type=int, default=20, help="Pages partitioned by one worker"
+    ),
+    click.option("--workers", type=int, default=None, help="Partitioning processes"),
+    click.option(
+        "--strategy",
+        type=click.Choice(["hi_res", "fast", "ocr_only"]),
+        default="hi_res",
+        help="Partitioning strategy of unstructured",
+    ),
+]
+
+
+def pipeline_options(command: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Options of PDF processing shared by `preprocess`, `classify` and `ingest`
+    """
+    for option in reversed(PIPELINE_OPTIONS):
+        command = option(command)
+    return command
 
 
 @click.group()
-def cli() -> None:
-    pass
+@click.option(
+    "--profile", type=click.Path(writable=True, path_type=Path), help=PROFILE_HELP
+)
+@click.pass_context
+def cli(ctx: click.Context, profile: Optional[Path]) -> None:
+    ctx.with_resource(trace.profiled(profile))
 
 
 @cli.command()
 @click.argument("pdf", type=click.Path(exists=True, path_type=Path))
 @click.argument("jsonl", type=click.Path(writable=True, path_type=Path))
-def preprocess(pdf: Path, jsonl: Path) -> None:
-    document_to_jsonl(pdf, jsonl)
+@pipeline_options
+@click.option(
+    "--non-interactive",
+    is_flag=True,
+    help="Don't ask, leave uncertain decisions for `review`",
+)
+@click.option(
+    "--threshold", type=float, default=0.8, help="Confidence of unattended decisions"
+)
+@click.option(
+    "--review",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="File of decisions for review, next to the PDF by default",
+)
+def preprocess(
+    pdf: Path,
+    jsonl: Path,
+    batch_size: int,
+    concurrency: int,
+    pages: int,
+    workers: Optional[int],
+    strategy: str,
+    non_interactive: bool,
+    threshold: float,
+    review: Optional[Path],
+) -> None:
+    document_to_jsonl(
+        pdf,
+        jsonl,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        pages=pages,
+        workers=workers,
+        strategy=strategy,
+        threshold=threshold if non_interactive else None,
+        review=review,
+    )
+    stats = store().stats()
+    click.echo(f"Cache: {stats['hits']} hits, {stats['misses']} misses")
+
+
+@cli.command()
+@click.argument("pdf", type=click.Path(exists=True, path_type=Path))
+@pipeline_options
+def classify(
+    pdf: Path,
+    batch_size: int,
+    concurrency: int,
+    pages: int,
+    workers: Optional[int],
+    strategy: str,
+) -> None:
+    """
+    Classifies snippets of PDF for `preprocess` with the same `--strategy`.
+    Several processes, including `preprocess` itself, share the work.
+    """
+    digest = checkpoint.digest(pdf)
+    elements = document_elements(pdf, digest, pages, workers, strategy)
+    ambiguous = [i for i, v in enumerate(layout_verdicts(elements)) if v is None]
+    known = Verdicts(store().directory.joinpath(".verdicts"))
+    verdicts = classify_shared(
+        elements.take(ambiguous),
+        shards_directory(pdf, digest, strategy),
+        batch_size,
+        concurrency,
+        known,
+    )
+    artifacts = sum(garbage for garbage, _ in verdicts)
+    click.echo(f"{len(verdicts)} snippets classified, {artifacts} artifacts")
+
+
+@cli.command("review")
+@click.argument("filename", type=click.Path(exists=True, path_type=Path))
+def review_decisions(filename: Path) -> None:
+    """
+    Answers decisions left by `preprocess --non-interactive`,
+    rerun it to apply them
+    """
+    review = Review(filename)
+    for entry in review.pending():
+        click.echo("\n---\n".join(entry["items"]))
+        entry["answer"] = click.confirm(entry["prompt"], default=entry["applied"])
+        review.save()
 
 
 @cli.command()
@@ -239,8 +1543,66 @@ def preprocess(pdf: Path, jsonl: Path) -> None:
 @click.argument(
     "db", type=click.Path(dir_okay=True, file_okay=False, writable=True, path_type=Path)
 )
-def upload(jsonl: Path, db: Path) -> None:
-    collection = ChromaFactory.from_jsonl(jsonl, db)
+@click.option("--batch-size", type=int, default=256, help="Elements per write")
+@click.option(
+    "--incremental", is_flag=True, help="Write only elements changed since last upload"
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["chroma", "numpy"]),
+    default="chroma",
+    help="Chroma collection or exact search over memory-mapped matrix",
+)
+def upload(
+    jsonl: Path, db: Path, batch_size: int, incremental: bool, backend: str
+) -> None:
+    from ulm.vectors import NumpyIndex
+
+    if incremental and backend == "numpy":
+        raise click.UsageError("--incremental works only with --backend chroma")
+
+    started = time.perf_counter()
+    if backend == "numpy":
+        count = NumpyIndex.build(
+            ChromaFactory.batches(jsonl, batch_size),
+            db,
+            ChromaFactory.embedding_function(),
+        ).count()
+    else:
+        NumpyIndex.remove(db)
+        count = ChromaFactory.from_jsonl(jsonl, db, batch_size, incremental).count()
+    elapsed = time.perf_counter() - started
+    click.echo(
+        f"Uploaded {count} elements in {elapsed:.1f}s ({count / elapsed:.1f} elements/s)"
+    )
+
+
+@cli.command()
+@click.argument("pdf", type=click.Path(exists=True, path_type=Path))
+@click.argument(
+    "db", type=click.Path(dir_okay=True, file_okay=False, writable=True, path_type=Path)
+)
+@pipeline_options
+def ingest(
+    pdf: Path,
+    db: Path,
+    batch_size: int,
+    concurrency: int,
+    pages: int,
+    workers: Optional[int],
+    strategy: str,
+) -> None:
+    """
+    Preprocesses PDF and uploads it to DB in one streaming pass,
+    accepting verdicts of the model without confirmation
+    """
+    from ulm.vectors import NumpyIndex
+
+    started = time.perf_counter()
+    NumpyIndex.remove(db)
+    collection = ingest_pdf(pdf, db, batch_size, concurrency, pages, workers, strategy)
+    elapsed = time.perf_counter() - started
+    click.echo(f"Ingested {collection.count()} elements in {elapsed:.1f}s")
 
 
 @cli.command()
@@ -248,6 +1610,129 @@ def upload(jsonl: Path, db: Path) -> None:
     "db", type=click.Path(exists=True, dir_okay=True, file_okay=False, path_type=Path)
 )
 @click.argument("question", type=str)
-def ask(db: Path, question: str) -> None:
-    collection = ChromaFactory.from_path(db)
-    click.echo(rag_ask(collection, question))
+@click.option("--no-cache", is_flag=True, help="Don't reuse answers to similar questions")
+@click.option(
+    "--similarity",
+    type=float,
+    default=None,
+    help="Minimal cosine similarity of a cached question  [default: 0.95]",
+)
+@click.option("--local", is_flag=True, help="Don't use running `serve` process")
+@click.option(
+    "--budget",
+    type=int,
+    default=None,
+    help="Tokens of context in the prompt  [default: 1500]",
+)
+def ask(
+    db: Path,
+    question: str,
+    no_cache: bool,
+    similarity: Optional[float],
+    local: bool,
+    budget: Optional[int],
+) -> None:
+    """
+    Answers QUESTION about DB, by the running `serve` process if there is one.
+    Options not given are taken from the server.
+    """
+    options = {
+        name: value
+        for name, value in [("similarity", similarity), ("budget", budget)]
+        if value is not None
+    }
+    answer = None if local else ask_server(db, question, not no_cache, **options)
+    if answer is not None:
+        click.echo(answer)
+        return
+
+    collection = ChromaFactory.storage(db)
+    cache = None if no_cache else ChromaFactory.answers(db)
+    click.echo(rag_ask(collection, question, cache, budget or 1500, similarity))
+
+
+@cli.command("ask-batch")
+@click.argument(
+    "db", type=click.Path(exists=True, dir_okay=True, file_okay=False, path_type=Path)
+)
+@click.argument("questions", type=click.Path(exists=True, path_type=Path))
+@click.argument("answers", type=click.Path(writable=True, path_type=Path))
+@click.option("--batch-size", type=int, default=32, help="Questions per retrieval")
+@click.option("--concurrency", type=int, default=4, help="Parallel LLM requests")
+@click.option(
+    "--budget", type=int, default=1500, help="Tokens of context in the prompt"
+)
+def ask_batch(
+    db: Path,
+    questions: Path,
+    answers: Path,
+    batch_size: int,
+    concurrency: int,
+    budget: int,
+) -> None:
+    """
+    Answers QUESTIONS from JSONL with `question` key, writes ANSWERS as JSONL.
+    Questions which failed get `error`, restart continues after the last
+    finished batch, whatever `--batch-size` is.
+    """
+    collection = ChromaFactory.storage(db)
+    with questions.open() as fd:
+        items = [json.loads(line) for line in fd]
+
+    cp = checkpoint.indexed(
+        filename=answers.with_name(answers.name + ".checkpoint"),
+        iterable=items,
+        initializer=0,
+    )
+    with answers.open("ab") as fd:
+        while batch := list(itertools.islice(cp, batch_size)):
+            index, _, offset = batch[-1]
+            fd.truncate(offset)  # drops answers of the interrupted batch
+            asked = [question for _, question, _ in batch]
+            for result in rag_ask_batch(collection, asked, concurrency, budget):
+                fd.write(json.dumps(result, ensure_ascii=False).encode() + b"\n")
+                fd.flush()
+            cp.save(index, fd.tell())
+        cp.saved()
+
+
+@cli.command()
+@click.argument(
+    "db", type=click.Path(exists=True, dir_okay=True, file_okay=False, path_type=Path)
+)
+@click.option("--port", type=int, default=0, help="Port on localhost, random by default")
+@click.option(
+    "--similarity",
+    type=float,
+    default=0.95,
+    help="Minimal cosine similarity of a cached question",
+)
+@click.option(
+    "--budget", type=int, default=1500, help="Tokens of context in the prompt"
+)
+def serve(db: Path, port: int, similarity: float, budget: int) -> None:
+    """
+    Answers `ask` commands for DB from one warm process.
+    Uploads are picked up on the next question.
+    """
+    storage = LatestStorage(db)
+    storage.get()
+    cache = ChromaFactory.answers(db, threshold=similarity)
+    cache.embed("")  # loads the embedding model
+
+    def answer(
+        question: str,
+        cached: bool,
+        similarity: Optional[float] = None,
+        budget: int = budget,
+    ) -> str:
+        return rag_ask(
+            storage.get(), question, cache if cached else None, budget, similarity
+        )
+
+    server = AskServer(db, port, answer)
+    click.echo(f"Serving {db} on port {server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
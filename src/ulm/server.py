@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+ADDRESS_FILE = "server.json"
+HOST = "127.0.0.1"
+
+
+class AskServer(ThreadingHTTPServer):
+    """
+    Local HTTP server which answers questions in threads,
+    keeping collection and models loaded between questions.
+    Address of the running server is written to the database directory.
+    `answer` takes the question, whether cached answers are allowed,
+    and options of the request.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, db: Path, port: int, answer: Callable[..., str]
+    ) -> None:
+        super().__init__((HOST, port), AskHandler)
+        self.answer = answer
+        self.address_file = db.joinpath(ADDRESS_FILE)
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        self.address_file.write_text(
+            json.dumps({"url": f"http://{HOST}:{self.server_port}", "pid": os.getpid()})
+        )
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.address_file.unlink(missing_ok=True)
+
+
+class AskHandler(BaseHTTPRequestHandler):
+    server: AskServer
+
+    def do_POST(self) -> None:
+        if self.path != "/ask":
+            self.send_error(404)
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        try:
+            answer = self.server.answer(
+                request["question"],
+                request.get("cache", True),
+                **request.get("options", {}),
+            )
+        except Exception as e:
+            self.send_json(500, {"error": repr(e)})
+        else:
+            self.send_json(200, {"answer": answer})
+
+    def send_json(self, code: int, value: dict) -> None:
+        body = json.dumps(value).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def ask_server(
+    db: Path, question: str, cache: bool = True, timeout: float = 300, **options: Any
+) -> Optional[str]:
+    """
+    Answer from the server running for `db`, `None` if there is no server,
+    it doesn't answer in `timeout` seconds or fails. `options` override
+    the ones the server was started with.
+    """
+    address_file = db.joinpath(ADDRESS_FILE)
+    if not address_file.exists():
+        return None
+
+    request = urllib.request.Request(
+        json.loads(address_file.read_text())["url"] + "/ask",
+        data=json.dumps(
+            {"question": question, "cache": cache, "options": options}
+        ).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())["answer"]
+    except urllib.error.HTTPError as e:
+        if e.code < 500:
+            raise
+        print(f"Server failed: {json.loads(e.read())['error']}", file=sys.stderr)
+        return None
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None  # server has gone away or hangs
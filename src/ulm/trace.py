@@ -0,0 +1,130 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import click
+
+
+class Tracer:
+    """
+    Collects spans of all threads, exports them in Chrome trace event format
+    (chrome://tracing, Perfetto)
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.spans: list[dict] = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, attributes: dict) -> Iterator[dict]:
+        started = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = repr(e)
+            raise
+        finally:
+            finished = time.perf_counter()
+            with self.lock:
+                self.spans.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (started - self.started) * 1e6,
+                        "dur": (finished - started) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": attributes,
+                    }
+                )
+
+    def export(self, filename: Path) -> None:
+        with self.lock:
+            filename.write_text(json.dumps({"traceEvents": self.spans}, default=str))
+
+    def summary(self) -> list[dict]:
+        """
+        Count, total and longest duration and tokens by span name
+        """
+        rows: dict[str, dict] = defaultdict(
+            lambda: {"count": 0, "total": 0.0, "max": 0.0, "tokens": 0}
+        )
+        with self.lock:
+            for span in self.spans:
+                row = rows[span["name"]]
+                row["count"] += 1
+                row["total"] += span["dur"] / 1e6
+                row["max"] = max(row["max"], span["dur"] / 1e6)
+                row["tokens"] += span["args"].get("prompt_tokens", 0)
+                row["tokens"] += span["args"].get("completion_tokens", 0)
+        return [
+            {"name": name, **row}
+            for name, row in sorted(rows.items(), key=lambda item: -item[1]["total"])
+        ]
+
+    def table(self) -> str:
+        lines = [f"{'span':<28}{'count':>7}{'total s':>10}{'max s':>9}{'tokens':>9}"]
+        for row in self.summary():
+            lines.append(
+                f"{row['name']:<28}{row['count']:>7}{row['total']:>10.3f}"
+                f"{row['max']:>9.3f}{row['tokens']:>9}"
+            )
+        return "\n".join(lines)
+
+
+class _Disabled:
+    def __enter__(self) -> dict:
+        return {}
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_tracer: Optional[Tracer] = None
+_disabled = _Disabled()
+
+
+def span(name: str, **attributes: Any) -> contextlib.AbstractContextManager[dict]:
+    """
+    Times the block when tracing is enabled.
+    Yields attributes of the span, which can be updated inside the block.
+    """
+    if _tracer is None:
+        return _disabled
+    return _tracer.span(name, attributes)
+
+
+def enable() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable() -> None:
+    global _tracer
+    _tracer = None
+
+
+@contextlib.contextmanager
+def profiled(filename: Optional[Path]) -> Iterator[None]:
+    """
+    Traces the block into `filename` and prints summary of spans,
+    does nothing without `filename`
+    """
+    if filename is None:
+        yield
+        return
+
+    tracer = enable()
+    try:
+        yield
+    finally:
+        disable()
+        tracer.export(filename)
+        click.echo(tracer.table(), err=True)
@@ -0,0 +1,156 @@
+import json
+import uuid
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterable, Optional, Protocol, Sequence
+
+import numpy as np
+
+from ulm.checkpoint import dump_atomic
+
+
+class Retriever(Protocol):
+    """
+    Part of `chromadb.Collection` interface used for answering questions
+    """
+
+    @property
+    def metadata(self) -> Optional[dict]:
+        ...
+
+    def count(self) -> int:
+        ...
+
+    def query(
+        self,
+        query_embeddings: Optional[Sequence[Sequence[float]]] = None,
+        query_texts: Optional[str | list[str]] = None,
+        n_results: int = 10,
+        include: Sequence[str] = ("metadatas", "documents", "distances"),
+    ) -> dict[str, Any]:
+        ...
+
+
+class NumpyIndex:
+    """
+    Exact search over normalized float32 embeddings in a memory-mapped matrix.
+    Ids, documents and pages are kept in a side table in the same order,
+    the table names the matrix of its revision.
+    """
+
+    table_name = "table.json"
+
+    def __init__(
+        self, path: Path, embedding_function: Callable[[list[str]], Any]
+    ) -> None:
+        self.table = json.loads(path.joinpath(self.table_name).read_text())
+        self.embeddings = np.load(
+            self.matrix(path, self.table["revision"]), mmap_mode="r"
+        )
+        self.embedding_function = embedding_function
+
+    @classmethod
+    def exists(cls, path: Path) -> bool:
+        return path.joinpath(cls.table_name).exists()
+
+    @classmethod
+    def remove(cls, path: Path) -> None:
+        path.joinpath(cls.table_name).unlink(missing_ok=True)
+        for matrix in path.glob("embeddings-*.npy"):
+            matrix.unlink()
+
+    @staticmethod
+    def matrix(path: Path, revision: str) -> Path:
+        return path.joinpath(f"embeddings-{revision}.npy")
+
+    @classmethod
+    def build(
+        cls,
+        batches: Iterable[dict[str, list]],
+        destination: Path,
+        embedding_function: Callable[[list[str]], Any],
+    ) -> "NumpyIndex":
+        """
+        Embeds batches in the format of `chromadb.Collection.add` arguments.
+        The matrix of a new revision is written first, then the table is
+        replaced atomically, so readers never pair a table with another
+        matrix. The previous matrix is kept for readers which have just
+        read the previous table, older ones are removed.
+        """
+        table: dict[str, Any] = {"ids": [], "documents": [], "pages": []}
+        embeddings = []
+        for batch in batches:
+            table["ids"] += batch["ids"]
+            table["documents"] += batch["documents"]
+            table["pages"] += [m.get("page", -1) for m in batch["metadatas"]]
+            embeddings.append(normalized(embedding_function(batch["documents"])))
+        table["revision"] = uuid.uuid4().hex
+
+        destination.mkdir(parents=True, exist_ok=True)
+        keep = {cls.matrix(destination, table["revision"])}
+        if cls.exists(destination):
+            previous = json.loads(destination.joinpath(cls.table_name).read_text())
+            keep.add(cls.matrix(destination, previous["revision"]))
+        dump_atomic(
+            cls.matrix(destination, table["revision"]),
+            np.concatenate(embeddings) if embeddings else np.zeros((0, 0), np.float32),
+            lambda matrix, fd: np.save(fd, matrix),
+        )
+        dump_atomic(destination.joinpath(cls.table_name), table, _dump_json)
+        for matrix in destination.glob("embeddings-*.npy"):
+            if matrix not in keep:
+                matrix.unlink(missing_ok=True)
+        return cls(destination, embedding_function)
+
+    @property
+    def metadata(self) -> dict:
+        return {"revision": self.table["revision"]}
+
+    def count(self) -> int:
+        return len(self.table["ids"])
+
+    def query(
+        self,
+        query_embeddings: Optional[Sequence[Sequence[float]]] = None,
+        query_texts: Optional[str | list[str]] = None,
+        n_results: int = 10,
+        include: Sequence[str] = ("metadatas", "documents", "distances"),
+    ) -> dict[str, Any]:
+        if query_embeddings is None:
+            assert query_texts is not None
+            texts = [query_texts] if isinstance(query_texts, str) else query_texts
+            query_embeddings = self.embedding_function(texts)
+
+        n_results = min(n_results, self.count())
+        if n_results == 0:
+            return {key: [[] for _ in query_embeddings] for key in ["ids", *include]}
+
+        similarity = normalized(query_embeddings) @ self.embeddings.T
+        top = np.argpartition(-similarity, n_results - 1, axis=1)[:, :n_results]
+        order = np.take_along_axis(similarity, top, axis=1).argsort(axis=1)[:, ::-1]
+        top = np.take_along_axis(top, order, axis=1)
+
+        result: dict[str, Any] = {
+            "ids": [[self.table["ids"][i] for i in row] for row in top]
+        }
+        if "documents" in include:
+            result["documents"] = [
+                [self.table["documents"][i] for i in row] for row in top
+            ]
+        if "metadatas" in include:
+            result["metadatas"] = [
+                [{"page": self.table["pages"][i]} for i in row] for row in top
+            ]
+        if "distances" in include:
+            result["distances"] = (
+                1 - np.take_along_axis(similarity, top, axis=1)
+            ).tolist()
+        return result
+
+
+def _dump_json(value: Any, fd: BinaryIO) -> None:
+    fd.write(json.dumps(value, ensure_ascii=False).encode())
+
+
+def normalized(embeddings: Any) -> np.ndarray:
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
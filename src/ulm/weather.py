@@ -1,16 +1,24 @@
-import os
+import functools
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator, Optional, TextIO
 
 import click
-import openai
 import requests
 
+import ulm.checkpoint as checkpoint
+import ulm.config as config
+import ulm.llm as llm
+import ulm.trace as trace
 
-latitude = os.environ["LOCATION_LATITUDE"]
-longitude = os.environ["LOCATION_LONGITUDE"]
-owm_key = os.environ["OPENWEATHERMAP_KEY"]
+OWM_API_BASE = "https://api.openweathermap.org/data/2.5"
+FRESH_SECONDS = 600  # upstream updates datapoints about every 10 minutes
+RETRY_SECONDS = 60  # don't ask again for a datapoint which is already late
+DEFAULT_ACTIVITY = "30 minutes walk in the park"
 
 
 @dataclass
@@ -97,17 +105,95 @@ class Weather:
         )
 
 
-def current_weather() -> Weather:
-    response = requests.get(
-        "https://api.openweathermap.org/data/2.5/weather",
-        params={"lat": latitude, "lon": longitude, "appid": owm_key, "units": "metric"},
-    )
-    response.raise_for_status()
-    return Weather.from_openweathermap(response.json())
+@functools.cache
+def session() -> requests.Session:
+    return requests.Session()
+
+
+class WeatherCache:
+    """
+    Raw responses of OpenWeatherMap on disk, one JSON file per location.
+    A response is fresh until the next datapoint is expected upstream.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def filename(self, latitude: str, longitude: str, units: str) -> Path:
+        return self.path.joinpath(f"weather-{latitude}-{longitude}-{units}.json")
+
+    def get(self, latitude: str, longitude: str, units: str) -> Optional[dict]:
+        try:
+            return json.loads(self.filename(latitude, longitude, units).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, latitude: str, longitude: str, units: str, vals: dict) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        checkpoint.dump_atomic(
+            self.filename(latitude, longitude, units),
+            {"fetched": time.time(), "response": vals},
+            self._dump,
+        )
+
+    @staticmethod
+    def _dump(value: Any, fd: BinaryIO) -> None:
+        fd.write(json.dumps(value).encode())
+
+    @staticmethod
+    def fresh(entry: dict, now: float) -> bool:
+        return (
+            now - entry["response"]["dt"] < FRESH_SECONDS
+            or now - entry["fetched"] < RETRY_SECONDS
+        )
+
+
+def weather_cache() -> WeatherCache:
+    # out of reach of eviction of `checkpoint.Store` in the same directory
+    return WeatherCache(config.cache_dir().joinpath("weather"))
+
+
+def current_weather(
+    latitude: Optional[str] = None,
+    longitude: Optional[str] = None,
+    units: str = "metric",
+    cache: Optional[WeatherCache] = None,
+) -> Weather:
+    """
+    Weather from cache while it's fresh, stale cache if OpenWeatherMap fails
+    """
+    latitude = latitude or config.require("LOCATION_LATITUDE")
+    longitude = longitude or config.require("LOCATION_LONGITUDE")
+    entry = cache.get(latitude, longitude, units) if cache else None
+    if entry is not None and WeatherCache.fresh(entry, time.time()):
+        return Weather.from_openweathermap(entry["response"])
+
+    try:
+        with trace.span("weather.fetch", latitude=latitude, longitude=longitude):
+            response = session().get(
+                config.get("OPENWEATHERMAP_API_BASE", OWM_API_BASE) + "/weather",
+                params={
+                    "lat": latitude,
+                    "lon": longitude,
+                    "appid": config.require("OPENWEATHERMAP_KEY"),
+                    "units": units,
+                },
+                timeout=30,
+            )
+            response.raise_for_status()
+    except requests.RequestException:
+        if entry is None:
+            raise
+        return Weather.from_openweathermap(entry["response"])
+
+    vals = response.json()
+    if cache:
+        cache.put(latitude, longitude, units, vals)
+    return Weather.from_openweathermap(vals)
 
 
 def what_to_wear(weather: Weather, activity: str) -> str:
-    completion = openai.ChatCompletion.create(
+    completion = llm.client().chat(
         model="gpt-3.5-turbo",
         messages=[
             {
@@ -127,9 +213,88 @@ def what_to_wear(weather: Weather, activity: str) -> str:
     return completion["choices"][0]["message"]["content"]
 
 
+def advise_locations(
+    locations: list[dict],
+    concurrency: int = 4,
+    cache: Optional[WeatherCache] = None,
+    fetches: int = 8,
+) -> Iterator[dict]:
+    """
+    Fetches weather for distinct locations with at most `fetches` requests
+    in flight, then asks for advice with at most `concurrency` LLM requests.
+    Yields locations with `weather` and `advice` (or `error`) as they complete.
+    """
+    sites = {(str(loc["latitude"]), str(loc["longitude"])) for loc in locations}
+    with (
+        ThreadPoolExecutor(max_workers=max(1, min(fetches, len(sites)))) as fetching,
+        ThreadPoolExecutor(max_workers=concurrency) as advising,
+    ):
+        weathers = {
+            site: fetching.submit(current_weather, *site, cache=cache) for site in sites
+        }
+
+        def advise(location: dict) -> dict:
+            try:
+                weather = weathers[
+                    str(location["latitude"]), str(location["longitude"])
+                ].result()
+            except Exception as e:
+                return {**location, "error": repr(e)}
+
+            result = {**location, "weather": weather.description()}
+            try:
+                activity = location.get("activity", DEFAULT_ACTIVITY)
+                result["advice"] = what_to_wear(weather, activity)
+            except Exception as e:
+                result["error"] = repr(e)
+            return result
+
+        futures: list[Future] = [advising.submit(advise, loc) for loc in locations]
+        for future in as_completed(futures):
+            yield future.result()
+
+
 @click.command()
-@click.option("-a", "--activity", type=str, default="30 minutes walk in the park")
-def cli(activity: Optional[str]):
-    weather = current_weather()
+@click.option("-a", "--activity", type=str, default=DEFAULT_ACTIVITY)
+@click.option("--no-cache", is_flag=True, help="Always ask OpenWeatherMap")
+@click.option(
+    "--locations",
+    type=click.File(),
+    help="JSONL with `latitude`, `longitude` and optional `activity`",
+)
+@click.option("--concurrency", type=int, default=4, help="Parallel LLM requests")
+@click.option(
+    "--fetches", type=int, default=8, help="Parallel OpenWeatherMap requests"
+)
+@click.option(
+    "--profile",
+    type=click.Path(writable=True, path_type=Path),
+    help="Write JSON trace of requests and print their summary",
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    activity: str,
+    no_cache: bool,
+    locations: Optional[TextIO],
+    concurrency: int,
+    fetches: int,
+    profile: Optional[Path],
+):
+    """
+    Recommends what to wear for the weather at home, or at every location
+    from a file, printed as JSONL in order of completion
+    """
+    ctx.with_resource(trace.profiled(profile))
+    cache = None if no_cache else weather_cache()
+    if locations is not None:
+        items = [json.loads(line) for line in locations if line.strip()]
+        for item in items:
+            item.setdefault("activity", activity)
+        for result in advise_locations(items, concurrency, cache, fetches):
+            click.echo(json.dumps(result, ensure_ascii=False))
+        return
+
+    weather = current_weather(cache=cache)
     click.echo(weather.description())
     click.echo(what_to_wear(weather, activity))
@@ -1,5 +1,6 @@
 import tempfile
 from pathlib import Path
+from collections.abc import Sequence
 from itertools import cycle
 from unittest.mock import Mock, call
 
@@ -94,3 +95,207 @@ def test_indexed_restores_from_the_middle():
         codeblock.assert_has_calls([call(i) for i in range(3, 5)])
         assert set(first) < set(second)  # is subset
         assert set(second) - set(first) == {4}
+
+
+class CountingSequence(Sequence):
+    def __init__(self, items):
+        self.items = items
+        self.accessed = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        self.accessed.append(index)
+        return self.items[index]
+
+
+def test_indexed_seeks_sequence():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = Path(tempdir).joinpath("indexed.cp")
+
+        items = CountingSequence(list(range(10)))
+        cp = checkpoint.indexed(filename, iterable=items, once_in=3, initializer=[])
+        for index, item, context in cp:
+            context.append(item)
+            cp.save(index, context)
+            if index == 6:
+                break
+
+        items = CountingSequence(list(range(10)))
+        cp = checkpoint.indexed(filename, iterable=items, once_in=3, initializer=[])
+        for index, item, context in cp:
+            context.append(item)
+            cp.save(index, context)
+        else:
+            result = cp.saved()
+
+        assert items.accessed == [6, 7, 8, 9]
+        assert result == list(range(10))
+
+
+def test_indexed_seeks_jsonlines():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = Path(tempdir).joinpath("indexed.cp")
+        source = Path(tempdir).joinpath("source.jsonl")
+        source.write_text("".join(f'{{"value": {i}}}\n' for i in range(5)))
+
+        cp = checkpoint.indexed(
+            filename, iterable=checkpoint.JsonLines(source), initializer=[]
+        )
+        for index, item, context in cp:
+            context.append(item["value"])
+            cp.save(index, context)
+            if index == 2:
+                break
+
+        # rewrite processed lines: resumed run must not read them
+        content = source.read_bytes()
+        offset = len(content.split(b"\n", 3)[3])
+        source.write_bytes(b"x" * (len(content) - offset) + content[-offset:])
+
+        cp = checkpoint.indexed(
+            filename, iterable=checkpoint.JsonLines(source), initializer=[]
+        )
+        for index, item, context in cp:
+            context.append(item["value"])
+            cp.save(index, context)
+        else:
+            result = cp.saved()
+
+        assert result == list(range(5))
+
+
+def test_journaled_appends_only_deltas():
+    items = list(range(10))
+    append = lambda context, delta: context + [delta]
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = Path(tempdir).joinpath("journaled.cp")
+
+        cp = checkpoint.journaled(filename, items, apply=append, initializer=[])
+        sizes = []
+        for index, item, context in cp:
+            cp.save(index, item)
+            sizes.append(cp.journal.stat().st_size)
+            if index == 6:
+                break
+
+        growth = [b - a for a, b in zip(sizes, sizes[1:])]
+        assert max(growth) == min(growth)  # independent of the context size
+
+        # record interrupted by crash is ignored
+        with cp.journal.open("ab") as fd:
+            fd.write(b"\x80\x04\x95")
+
+        codeblock = Mock(wraps=lambda value: value)
+        cp = checkpoint.journaled(filename, items, apply=append, initializer=[])
+        for index, item, context in cp:
+            cp.save(index, codeblock(item))
+        else:
+            result = cp.saved()
+
+        codeblock.assert_has_calls([call(i) for i in range(7, 10)])
+        assert codeblock.call_count == 3
+        assert result == items
+        assert not cp.journal.exists()
+
+        # compacted checkpoint restores without replaying
+        cp = checkpoint.journaled(filename, items, apply=append, initializer=[])
+        assert list(cp) == []
+        assert cp.saved() == items
+
+
+def test_memoized():
+    codeblock = Mock(side_effect=cycle(["VALUE1", "VALUE2"]))
+    with tempfile.TemporaryDirectory() as tempdir:
+        store = checkpoint.Store(Path(tempdir).joinpath("store"))
+        original = Path(tempdir).joinpath("original.pdf")
+        original.write_bytes(b"content")
+        copy = Path(tempdir).joinpath("copy.pdf")
+        copy.write_bytes(b"content")
+
+        def run(filename):
+            with checkpoint.memoized(store, checkpoint.digest(filename), x=1) as cp:
+                if not (value := cp.saved()):
+                    value = cp.save(codeblock())
+            return value
+
+        first = run(original)
+        assert run(copy) == first  # same content under different path
+        codeblock.assert_called_once()
+
+        original.write_bytes(b"changed")
+        assert run(original) != first
+        assert store.stats() == {"hits": 1, "misses": 2}
+
+
+def test_store_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as tempdir:
+        store = checkpoint.Store(Path(tempdir), max_bytes=2500)
+        other = Path(tempdir).joinpath("weather")
+        other.mkdir()
+        other.joinpath("entry").write_bytes(b"x" * 1000)
+        for key in ["a", "b", "c"]:
+            with checkpoint.memoized(store, key) as cp:
+                cp.save(b"x" * 1000)
+
+        assert not store.filename("a").exists()
+        assert store.filename("b").exists()
+        assert store.filename("c").exists()
+        assert other.joinpath("entry").exists()  # another cache
+
+
+def test_journaled_rewinds():
+    items = list(range(10))
+    append = lambda context, delta: context.append(delta) or context
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = Path(tempdir).joinpath("journaled.cp")
+
+        cp = checkpoint.journaled(filename, items, apply=append, initializer=[], once_in=3)
+        for index, item, context in cp:
+            cp.save(index, item)
+        else:
+            assert cp.saved(compact=False) == items
+        assert cp.journal.exists()
+
+        # items from the record which includes index 7 are processed again
+        cp = checkpoint.journaled(filename, items, apply=append, initializer=[], once_in=3)
+        cp.rewind(7)
+        assert [index for index, _, _ in cp] == [6, 7, 8, 9]
+        assert cp._context == list(range(6))
+
+        # compacted items start over
+        cp.saved()
+        cp = checkpoint.journaled(filename, items, apply=append, initializer=[], once_in=3)
+        cp.rewind(7)
+        assert len(list(cp)) == 10
+        assert cp._context == []
+
+
+def test_sharded_claims_and_takes_over():
+    with tempfile.TemporaryDirectory() as tempdir:
+        directory = Path(tempdir)
+        items = list("abcdefg")
+        worker1 = checkpoint.sharded(directory, items, shard_size=3, initializer="")
+        worker2 = checkpoint.sharded(directory, items, shard_size=3, initializer="")
+
+        shard = worker1.claim()
+        assert shard is not None and shard.start == 0
+        for index, item, context in shard:
+            shard.save(index, context + item)
+            if index == 1:
+                break  # crash in the middle of the shard
+        with worker2.claim() as other:
+            assert other.start == 3  # the first shard is still locked
+
+        shard.__exit__(None, None, None)  # lock is released by the system
+        processed = []
+        for shard in worker2.claims(poll=0):
+            for index, item, context in shard:
+                processed.append(index)
+                shard.save(index, context + item)
+            shard.saved()
+
+        assert processed == [2, 3, 4, 5, 6]
+        assert worker1.pending() == []
+        assert worker1.merged(lambda a, b: a + b) == "abcdefg"
@@ -0,0 +1,39 @@
+import tempfile
+from pathlib import Path
+
+from unstructured.documents.elements import ElementMetadata, NarrativeText, Title
+
+import ulm.checkpoint as checkpoint
+from ulm.columns import Columns
+
+
+def test_columns_roundtrip():
+    elements = [
+        Title("Patchwork", metadata=ElementMetadata(page_number=1)),
+        NarrativeText("Repair as practice — “improvisational” labor."),
+        NarrativeText("", metadata=ElementMetadata(page_number=2)),
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = Path(tempdir).joinpath("elements")
+        with checkpoint.singular(
+            filename, load=Columns.load, dump=Columns.dump
+        ) as cp:
+            cp.save(elements)
+            columns = cp.saved()
+
+        assert len(columns) == 3
+        assert [row.to_dict() for row in columns] == [
+            {
+                "type": e.category,
+                "element_id": e.id,
+                "metadata": {"page_number": e.metadata.page_number}
+                if e.metadata.page_number
+                else {},
+                "text": e.text,
+            }
+            for e in elements
+        ]
+
+        selection = columns.take([2, 0])
+        assert [row.category for row in selection] == ["NarrativeText", "Title"]
+        assert selection[1].page == 1
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from ulm.llm import LLM, RetryableError, TokenBucket
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    responses: list[tuple[int, dict]] = []
+    requests: list[dict] = []
+
+    def do_POST(self):
+        self.requests.append(
+            {
+                "path": self.path,
+                "body": json.loads(self.rfile.read(int(self.headers["Content-Length"]))),
+                "authorization": self.headers["Authorization"],
+            }
+        )
+        status, headers = self.responses.pop(0)
+        body = json.dumps({"choices": [{"text": "ok"}]}).encode()
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_openai():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    FakeOpenAI.requests = []
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", FakeOpenAI
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_llm_retries_rate_limited_requests(fake_openai):
+    url, fake = fake_openai
+    fake.responses = [
+        (429, {"retry-after": "0.01"}),
+        (503, {}),
+        (200, {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "5"}),
+    ]
+    client = LLM("key", base_url=url, backoff=0.01)
+
+    assert client.completion(model="m", prompt="p") == {"choices": [{"text": "ok"}]}
+    assert len(fake.requests) == 3
+    assert fake.requests[0] == {
+        "path": "/v1/completions",
+        "body": {"model": "m", "prompt": "p"},
+        "authorization": "Bearer key",
+    }
+    assert client.requests.capacity == 60
+    assert client.requests.available <= 5
+
+
+def test_llm_gives_up_after_retries(fake_openai):
+    url, fake = fake_openai
+    fake.responses = [(429, {}), (429, {})]
+    client = LLM("key", base_url=url, max_retries=1, backoff=0.01)
+
+    with pytest.raises(requests.HTTPError):
+        client.chat(model="m", messages=[])
+
+
+def test_llm_retry_delay():
+    def delay(attempt, **headers):
+        response = requests.Response()
+        response.headers.update(headers)
+        return client._retry_delay(attempt, RetryableError(response, Exception()))
+
+    client = LLM("key", backoff=1.0)
+    limited = {"x-ratelimit-reset-requests": "2s", "x-ratelimit-reset-tokens": "6s"}
+
+    assert 2 <= delay(0, **limited) <= 3
+    assert 6 <= delay(0, **limited, **{"x-ratelimit-remaining-tokens": "0"}) <= 7
+    assert 8 <= delay(3, **limited) <= 16  # the backoff keeps growing
+    assert 5 <= delay(0, **{"retry-after": "5"}) <= 6
+    assert len({delay(0, **{"retry-after": "5"}) for _ in range(5)}) > 1
+
+
+def test_llm_async(fake_openai):
+    url, fake = fake_openai
+    fake.responses = [(200, {}), (200, {}), (500, {}), (200, {})]
+    client = LLM("key", base_url=url, backoff=0.01)
+
+    async def ask():
+        return await asyncio.gather(
+            *(client.achat(model="m", messages=[]) for _ in range(3))
+        )
+
+    assert len(asyncio.run(ask())) == 3
+    assert len(fake.requests) == 4
+
+
+def test_token_bucket_delays_over_limit():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.take(60) == 0
+    assert bucket.take(30) == pytest.approx(30, abs=0.1)
@@ -1,8 +1,45 @@
+import json
+import time
+from array import array
+from unittest.mock import Mock, patch
+
+import pypdfium2 as pdfium
 import pytest
+from click.testing import CliRunner
 
+from unstructured.documents.coordinates import RelativeCoordinateSystem
+from unstructured.documents.elements import ElementMetadata, NarrativeText
 from unstructured.partition.text import element_from_text, Text
 
-from ulm.pdf import needs_merge, is_garbage
+from ulm.pdf import (
+    needs_merge,
+    is_garbage,
+    is_garbage_batch,
+    classify_garbage,
+    classify_shared,
+    Verdicts,
+    layout_verdicts,
+    partition_chunks,
+    pdf_to_elements,
+    ingest_pdf,
+    merge_stream,
+    staged,
+    unattended,
+    Policy,
+    Review,
+    rewind_merge,
+    ChromaFactory,
+    AnswerCache,
+    LatestStorage,
+    revision,
+    rag_ask,
+    cli,
+    pack_context,
+)
+from ulm.checkpoint import Store, journaled
+from ulm.columns import Row
+from ulm.columns import Columns
+from chromadb.api.types import EmbeddingFunction
 
 p1 = "Staying with repair as practice allows for a more careful consideration of how human labor works in and through infrastructure. Building on theorizations of repair and maintenance as improvisational and adaptive labor, driven by human ingenuity (Graham and Thrift, 2007), I push these arguments forward by considering how that work is learned, carried out, and how it emerges from the specific geohistorical context of the Mexico City’s networked water system. Namely, I show how patchwork is a result of structural austerity, widespread (yet unequal and uneven) infrastructural decay, and of the changing flows of urban water and urban soil. Patchwork is an improvisational logic that enables the city to"
 footer_text = "De Coss-Corzo"
@@ -11,6 +48,20 @@ p2 = "endure not by returning “to a former, officially authorized state” (Ba
 p3 = "The observations discussed here were gathered through a one-year ethnography at SACMEX. I focus particularly on the participant observation carried out with four SACMEX repair teams, each composed of 5–7 workers, with whom I worked full-time the Lerma System shifts two or three times per week. Two teams were part of Subdirectorate, based in Lerma, a periurban area in the state of Mexico, which supplies 12% of Mexico City’s water (SACMEX, 2018). The other two were part of the Mexico Citybased West Subdirectorate and worked in three Mexico City alcaldıas (boroughs) and one state of Mexico municipality—Huixquilucan. My role within these teams shifted as time went by. At the beginning I limited myself to observing, documenting, and carrying out informal interviews with workers. After two months, I started to help carrying tools and materials. Toward the middle of my fieldwork, I began engaging in minor repair and maintenance activities, in particular with one team in Lerma. My analysis of workers’ attitudes, resources, and practices when performing their labor comes from this embodied research experience as well. In all cases, their names have been changed, and locations have been made purposefully vague to ensure their anonymity."
 
 
+
+class Embedding(EmbeddingFunction):
+    def __init__(self):
+        pass
+
+    def __call__(self, input):
+        return [[float(len(text)), 1.0] for text in input]
+
+
+@pytest.fixture
+def embedding(monkeypatch):
+    monkeypatch.setattr(ChromaFactory, "embedding_function", staticmethod(Embedding))
+
+
 @pytest.mark.parametrize(
     "e1, e2, expected",
     [
@@ -36,3 +87,541 @@ def test_needs_merge(e1, e2, expected):
 def test_is_garbage(e, expected):
     garbage, explanation = is_garbage(Text(e))
     assert garbage is expected, explanation
+
+
+def test_is_garbage_batch_parses_verdicts():
+    batch = [Text(footer_text), Text(page_number), Text("Keywords repair")]
+    response = {
+        "choices": [
+            {
+                "text": "[1] Author's name from the header. Artifact\n"
+                "[2] Looks like page number. Artifact\n"
+            }
+        ]
+    }
+    fallback = {"choices": [{"text": "This is keyword section. Meaningful"}]}
+    with patch("ulm.llm.client") as client:
+        api = client.return_value.completion
+        api.side_effect = [response, fallback]
+        verdicts = is_garbage_batch(batch)
+
+    assert [garbage for garbage, _ in verdicts] == [True, True, False]
+    assert api.call_count == 2  # unanswered snippet is classified separately
+
+
+def test_classify_garbage_skips_narrative_text():
+    elements = [NarrativeText(p1), Text(page_number), NarrativeText(p2)]
+    with patch("ulm.pdf.is_garbage_batch", return_value=[(True, "")]) as batch:
+        verdicts = classify_garbage(elements, batch_size=2)
+
+    batch.assert_called_once()
+    assert [garbage for garbage, _ in verdicts] == [False, True, False]
+
+
+def test_classify_garbage_reuses_verdicts(tmp_path):
+    cache = Verdicts(tmp_path.joinpath("verdicts"))
+    elements = [Text("Page 3"), Text("Page  14"), Text(footer_text)]
+    with patch(
+        "ulm.pdf.is_garbage_batch", side_effect=lambda batch: [(True, "")] * len(batch)
+    ) as batch:
+        classify_garbage(elements, cache=cache)
+        assert batch.call_args.args[0] == [elements[0], elements[2]]
+
+        verdicts = classify_garbage([Text("Page 27"), Text(footer_text)], cache=cache)
+
+    batch.assert_called_once()
+    assert verdicts == [(True, ""), (True, "")]
+    assert cache.hits == 2
+
+
+def test_classify_shared(tmp_path):
+    elements = [Text(word) for word in ["Contents", "Notes", "Index", "Fig", "Table"]]
+    with patch(
+        "ulm.pdf.is_garbage_batch", side_effect=lambda batch: [(True, "")] * len(batch)
+    ) as batch:
+        verdicts = classify_shared(elements, tmp_path, batch_size=1, shard_size=2)
+        assert verdicts == [(True, "")] * 5
+        assert batch.call_count == 5
+
+        # done shards are reused by other processes, whatever their options
+        assert classify_shared(elements, tmp_path, batch_size=3, shard_size=2) == verdicts
+        assert classify_shared(elements, tmp_path, concurrency=1, shard_size=2) == verdicts
+        assert batch.call_count == 5
+
+
+def test_layout_verdicts(tmp_path):
+    def element(text, page, y, cls=Text):
+        system = RelativeCoordinateSystem()
+        return cls(
+            text,
+            coordinates=((0.1, y), (0.9, y)),
+            coordinate_system=system,
+            metadata=ElementMetadata(page_number=page),
+        )
+
+    elements = []
+    for page in range(1, 7):
+        elements += [
+            element("EPD: Society and Space 0(0)", page, 0.95),
+            element(str(page), page, 0.03),
+            element(p1, page, 0.5, NarrativeText),
+        ]
+    elements += [element("Keywords repair", 1, 0.6), element(p3, 2, 0.4)]
+
+    filename = tmp_path.joinpath("elements")
+    with filename.open("wb") as fd:
+        Columns.dump(elements, fd)
+    verdicts = layout_verdicts(Columns.open(filename))
+
+    assert [v and v[0] for v in verdicts[:3]] == [True, True, False]
+    assert verdicts[-2] is None  # left for the model
+    assert verdicts[-1][0] is False
+
+
+def fake_partition_pdf(filename, strategy):
+    pages = len(pdfium.PdfDocument(filename))
+    return [
+        Text(f"{filename} {page}", metadata=ElementMetadata(page_number=page))
+        for page in range(1, pages + 1)
+    ]
+
+
+def test_partition_chunks(tmp_path):
+    document = pdfium.PdfDocument.new()
+    for _ in range(5):
+        document.new_page(100, 100)
+    filename = tmp_path.joinpath("document.pdf")
+    document.save(filename)
+    cache = Store(tmp_path.joinpath("cache"))
+
+    with patch("unstructured.partition.pdf.partition_pdf", side_effect=fake_partition_pdf):
+        chunks = partition_chunks(filename, "digest", cache, pages=2, workers=2)
+        assert [row.page for chunk in chunks for row in chunk] == [1, 2, 3, 4, 5]
+
+        # finished ranges are not partitioned again
+        with patch("ulm.pdf.partition_pages") as partition:
+            partition_chunks(filename, "digest", cache, pages=2, workers=2)
+        partition.assert_not_called()
+
+
+def test_chroma_batches(tmp_path):
+    jsonl = tmp_path.joinpath("document.jsonl")
+    elements = [
+        {"type": "Title", "element_id": "t", "text": "Title", "metadata": {}},
+        *(
+            {
+                "type": "NarrativeText",
+                "element_id": f"e{i}",
+                "text": f"Text {i}.",
+                "metadata": {"page_number": i},
+            }
+            for i in range(5)
+        ),
+    ]
+    jsonl.write_text("".join(json.dumps(e) + "\n" for e in elements))
+
+    batches = list(ChromaFactory.batches(jsonl, batch_size=2))
+
+    assert [batch["ids"] for batch in batches] == [["e0", "e1"], ["e2", "e3"], ["e4"]]
+    assert batches[-1]["metadatas"] == [
+        {"page": 4, "hash": ChromaFactory.content_hash("Text 4.", 4)}
+    ]
+
+
+def test_chroma_upload_repeated_text(tmp_path, embedding):
+    # unstructured derives element ids from text only
+    records = [
+        {
+            "type": "Header",
+            "element_id": "header",
+            "text": "Journal",
+            "metadata": {"page_number": page},
+        }
+        for page in range(3)
+    ]
+
+    batches = list(ChromaFactory.record_batches(records, batch_size=10))
+    assert batches[0]["ids"] == ["header"]
+    assert batches[0]["metadatas"][0]["page"] == 0
+
+    collection = ChromaFactory.upload(batches, tmp_path)
+    assert collection.count() == 1
+
+    # repeated in the next batch, nothing changes on the next upload
+    batches = lambda: ChromaFactory.record_batches(
+        [{**records[0], "element_id": "paragraph"}, *records], batch_size=1
+    )
+    collection = ChromaFactory.upload(batches(), tmp_path, incremental=True)
+    first = revision(collection)
+    cls = collection.__class__
+    with patch.object(cls, "upsert", autospec=True) as upsert:
+        collection = ChromaFactory.upload(batches(), tmp_path, incremental=True)
+    upsert.assert_not_called()
+    assert revision(collection) == first
+
+
+def test_chroma_incremental_upload(tmp_path, embedding, capsys):
+    def records(texts):
+        return ChromaFactory.record_batches(
+            (
+                {
+                    "type": "NarrativeText",
+                    "element_id": element_id,
+                    "text": text,
+                    "metadata": {"page_number": 1},
+                }
+                for element_id, text in texts.items()
+            ),
+            batch_size=2,
+        )
+
+    # fresh database
+    collection = ChromaFactory.upload(
+        records({"a": "A.", "b": "B.", "c": "C."}), tmp_path, incremental=True
+    )
+    assert capsys.readouterr().out == "Unchanged: 0, upserted: 3, deleted: 0\n"
+    first = revision(collection)
+
+    changed = {"a": "A.", "b": "B changed.", "d": "D."}
+    cls = collection.__class__
+    with patch.object(cls, "upsert", autospec=True, side_effect=cls.upsert) as upsert:
+        collection = ChromaFactory.upload(records(changed), tmp_path, incremental=True)
+    assert capsys.readouterr().out == "Unchanged: 1, upserted: 2, deleted: 1\n"
+    assert [call.kwargs["ids"] for call in upsert.call_args_list] == [["b"], ["d"]]
+    stored = collection.get()
+    assert dict(zip(stored["ids"], stored["documents"])) == changed
+    assert revision(collection) != first
+
+    # nothing changed, revision is kept
+    second = revision(collection)
+    collection = ChromaFactory.upload(records(changed), tmp_path, incremental=True)
+    assert capsys.readouterr().out == "Unchanged: 3, upserted: 0, deleted: 0\n"
+    assert revision(collection) == second
+
+
+def test_upload_numpy_rejects_incremental(tmp_path):
+    jsonl = tmp_path.joinpath("document.jsonl")
+    jsonl.write_text("")
+    db = tmp_path.joinpath("db")
+    args = ["upload", str(jsonl), str(db), "--backend", "numpy", "--incremental"]
+
+    result = CliRunner().invoke(cli, args)
+
+    assert result.exit_code == 2
+    assert "--incremental" in result.output
+    assert not db.exists()
+
+
+def test_latest_storage_sees_uploads(tmp_path, embedding):
+    batch = lambda text: {
+        "ids": ["e"],
+        "documents": [text],
+        "metadatas": [{"page": 1, "hash": ChromaFactory.content_hash(text, 1)}],
+    }
+    ChromaFactory.upload([batch("Before.")], tmp_path)
+    storage = LatestStorage(tmp_path)
+    before = revision(storage.get())
+    assert storage.get() is storage.get()
+
+    ChromaFactory.upload([batch("After.")], tmp_path, incremental=True)
+    assert revision(storage.get()) != before
+
+
+def test_rag_ask_reuses_answers_to_similar_questions(tmp_path):
+    vectors = {"How is water repaired?": [1.0, 0.0], "How's water repaired?": [0.99, 0.01]}
+    embed = lambda texts: [vectors.get(text, [0.0, 1.0]) for text in texts]
+    cache = AnswerCache(tmp_path.joinpath("answers"), embed, threshold=0.9)
+    storage = Mock(metadata={"revision": "r1"})
+    storage.query.return_value = {"documents": [[p1, p2]]}
+    completion = {"choices": [{"message": {"content": "By patchwork."}}]}
+
+    with patch("ulm.llm.client") as client, patch(
+        "ulm.pdf.count_tokens", side_effect=lambda text: len(text.split())
+    ):
+        api = client.return_value.chat
+        api.return_value = completion
+        assert rag_ask(storage, "How is water repaired?", cache) == "By patchwork."
+        assert rag_ask(storage, "How's water repaired?", cache) == "By patchwork."
+        api.assert_called_once()
+
+        rag_ask(storage, "Who are the workers?", cache)
+        assert api.call_count == 2
+
+        storage.metadata = {"revision": "r2"}  # collection has changed
+        rag_ask(storage, "How is water repaired?", cache)
+        assert api.call_count == 3
+
+
+def test_ask_batch_resumes(tmp_path):
+    questions = tmp_path.joinpath("questions.jsonl")
+    questions.write_text(
+        "".join(json.dumps({"id": i, "question": f"Q{i}"}) + "\n" for i in range(5))
+    )
+    answers = tmp_path.joinpath("answers.jsonl")
+    storage = Mock()
+    storage.query.side_effect = lambda query_texts, **kwargs: {
+        "ids": [[f"id-{q}"] for q in query_texts],
+        "documents": [[f"doc-{q}"] for q in query_texts],
+    }
+    answered = []
+
+    def complete(question, documents, budget):
+        answered.append(question)
+        if question == "Q3" and answered.count(question) == 1:
+            raise KeyboardInterrupt()
+        if question == "Q4":
+            raise RuntimeError("rate limited")
+        return f"A{question[1:]}", {"prompt_tokens": 10}
+
+    runner = CliRunner()
+    with patch("ulm.pdf.ChromaFactory.from_path", return_value=storage), patch(
+        "ulm.pdf.complete_answer", side_effect=complete
+    ):
+        args = ["ask-batch", str(tmp_path), str(questions), str(answers)]
+        interrupted = runner.invoke(cli, [*args, "--batch-size", "2"])
+        assert interrupted.exit_code != 0
+
+        result = runner.invoke(cli, [*args, "--batch-size", "3", "--concurrency", "1"])
+        assert result.exit_code == 0, result.output
+
+    results = sorted(
+        (json.loads(line) for line in answers.read_text().splitlines()),
+        key=lambda r: r["id"],
+    )
+    assert [r.get("answer") for r in results] == ["A0", "A1", "A2", "A3", None]
+    assert results[3]["ids"] == ["id-Q3"]
+    assert results[3]["prompt_tokens"] == 10
+    assert results[4]["error"] == "RuntimeError('rate limited')"
+    # finished batch is not repeated after the batch size changes
+    assert answered.count("Q0") == answered.count("Q1") == 1
+
+
+def test_pack_context():
+    count = lambda text: len(text.split())
+    documents = [
+        "First sentence here. Second sentence here. Third one.",
+        "first sentence here.  Second sentence here. Third one.",
+        "Short relevant note.",
+        "Another long document that does not fit anymore at all.",
+    ]
+
+    packed = pack_context(documents, budget=10, count=count)
+
+    # duplicate is dropped, the last document is cut to the fitting sentences
+    assert packed == ["First sentence here. Second sentence here. Third one."]
+    assert pack_context(documents, budget=14, count=count) == [
+        documents[0],
+        documents[2],
+    ]
+    assert pack_context(documents, budget=5, count=count) == [
+        "First sentence here.",
+    ]
+
+
+def test_merge_stream():
+    rows = [
+        Row("Introduction", "Title", 1, "t", 0.9),
+        Row(p1, "NarrativeText", 1, "a", 0.5),
+        Row(footer_text, "UncategorizedText", 1, "f", 0.05),
+        Row(p2, "NarrativeText", 2, "b", 0.5),
+        Row(p3, "NarrativeText", 2, "c", 0.3),
+    ]
+    merged = lambda texts: {"text": " ".join(texts)}
+    with patch("ulm.pdf.merged_record", side_effect=merged):
+        records = list(merge_stream(rows, unattended))
+
+    # the paragraph is merged over the footer, which was not filtered
+    assert [r["text"] for r in records] == [
+        "Introduction",
+        f"{p1} {p2}",
+        f"{footer_text} {p2}",
+        p3,
+    ]
+
+
+def test_pdf_to_elements_depends_on_strategy(tmp_path, monkeypatch):
+    document = pdfium.PdfDocument.new()
+    document.new_page(100, 100)
+    filename = tmp_path.joinpath("document.pdf")
+    document.save(filename)
+    monkeypatch.setenv("ULM_CACHE", str(tmp_path.joinpath("cache")))
+
+    def partition_pdf(filename, strategy):
+        return [
+            NarrativeText(f"{strategy} {i}.", metadata=ElementMetadata(page_number=1))
+            for i in range({"fast": 2, "hi_res": 5}[strategy])
+        ]
+
+    with patch("unstructured.partition.pdf.partition_pdf", side_effect=partition_pdf):
+        for strategy in ["hi_res", "fast"]:
+            records = pdf_to_elements(filename, strategy=strategy, threshold=0.8)
+            assert [r["text"] for r in records] == [
+                f"{strategy} {i}." for i in range(len(records))
+            ]
+    assert len(records) == 2
+
+
+def test_pdf_to_elements_saves_review_before_crash(tmp_path, monkeypatch):
+    document = pdfium.PdfDocument.new()
+    document.new_page(100, 100)
+    filename = tmp_path.joinpath("document.pdf")
+    document.save(filename)
+    review = tmp_path.joinpath("review.jsonl")
+    monkeypatch.setenv("ULM_CACHE", str(tmp_path.joinpath("cache")))
+
+    def partition_pdf(filename, strategy):
+        return [
+            NarrativeText(
+                f"Part {i} of a paragraph split over the page",
+                metadata=ElementMetadata(page_number=1),
+            )
+            for i in range(10)
+        ]
+
+    def crashing(e1, e2):
+        if e1.text.startswith("Part 6"):
+            raise KeyboardInterrupt()
+        return needs_merge(e1, e2)
+
+    run = lambda: pdf_to_elements(filename, threshold=0.8, review=review)
+    merged = lambda texts: {"text": " ".join(texts)}
+    with patch(
+        "unstructured.partition.pdf.partition_pdf", side_effect=partition_pdf
+    ), patch("ulm.pdf.merged_record", side_effect=merged):
+        with patch("ulm.pdf.needs_merge", side_effect=crashing), pytest.raises(
+            KeyboardInterrupt
+        ):
+            run()
+        queued = {e["position"] for e in Review(review).pending()}
+        assert queued == {0, 2, 4}
+
+        run()
+    assert {e["position"] for e in Review(review).pending()} == {0, 2, 4, 6}
+
+
+def test_policy_leaves_uncertain_decisions_for_review(tmp_path):
+    filename = tmp_path.joinpath("review.jsonl")
+    policy = Policy(Review(filename), threshold=0.8)
+    assert policy(True, "Merge?", "a", key="merge:a:b", confidence=0.9, position=1)
+    assert policy(True, "Merge?", "c", key="merge:c:d", confidence=0.6, position=3)
+    assert not policy(False, "Merge?", "e", key="merge:e:f", confidence=0.1)
+    policy.review.save()
+
+    result = CliRunner().invoke(cli, ["review", str(filename)], input="n\n")
+    assert result.exit_code == 0, result.output
+    assert "c" in result.output
+
+    policy = Policy(Review(filename), threshold=0.8)
+    assert not policy.review.pending()
+    assert policy.changed("merge") == 3
+    assert not policy(True, "Merge?", "c", key="merge:c:d", confidence=0.6, position=3)
+    assert policy.changed("merge") is None
+
+
+def test_rewind_merge(tmp_path):
+    def run(kept, policy):
+        cp = journaled(tmp_path.joinpath("merged"), kept, lambda c, d: c + [d], initializer=[])
+        rewind_merge(cp, policy, tmp_path.joinpath("kept"), array("q", kept))
+        for index, element, _ in cp:
+            processed.append(element)
+            cp.save(index, element)
+        return cp.saved(compact=False)
+
+    policy = Policy(Review(tmp_path.joinpath("review.jsonl")))
+    processed = []
+    assert run(list(range(10)), policy) == list(range(10))
+    processed = []
+    assert run(list(range(10)), policy) == list(range(10))
+    assert processed == []
+
+    # the filter drops element 7, merge is redone from two elements before
+    assert run([0, 1, 2, 3, 4, 5, 6, 8, 9], policy) == [0, 1, 2, 3, 4, 5, 6, 8, 9]
+    assert processed == [5, 6, 8, 9]
+
+
+def test_staged():
+    produced = []
+
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    stream = staged(items(), maxsize=2)
+    assert next(stream) == 0
+    time.sleep(0.05)
+    assert len(produced) <= 4  # bounded by the queue
+    stream.close()
+
+    def failing():
+        yield 1
+        raise ValueError("broken stage")
+
+    with pytest.raises(ValueError, match="broken stage"):
+        list(staged(failing()))
+
+
+def test_ingest_pdf(tmp_path, monkeypatch, embedding):
+    document = pdfium.PdfDocument.new()
+    for _ in range(5):
+        document.new_page(100, 100)
+    filename = tmp_path.joinpath("document.pdf")
+    document.save(filename)
+    monkeypatch.setenv("ULM_CACHE", str(tmp_path.joinpath("cache")))
+
+    def partition_pdf(filename, strategy):
+        pages = len(pdfium.PdfDocument(filename))
+        return [
+            NarrativeText(
+                f"Paragraph {page} of {filename}.",
+                metadata=ElementMetadata(page_number=page),
+            )
+            for page in range(1, pages + 1)
+        ]
+
+    db = tmp_path.joinpath("db")
+    with patch("unstructured.partition.pdf.partition_pdf", side_effect=partition_pdf):
+        collection = ingest_pdf(filename, db, pages=2, workers=1)
+        assert collection.count() == 5
+        pages = sorted(m["page"] for m in collection.get()["metadatas"])
+        assert pages == [1, 2, 3, 4, 5]
+
+        # ranges are memoized, nothing is uploaded again
+        with patch("ulm.pdf.partition_pages") as partition, patch.object(
+            collection.__class__, "upsert"
+        ) as upsert:
+            ingest_pdf(filename, db, pages=2, workers=1)
+        partition.assert_not_called()
+        upsert.assert_not_called()
+
+
+def test_ingest_pdf_classifies_ambiguous_elements(tmp_path, monkeypatch, embedding):
+    document = pdfium.PdfDocument.new()
+    for _ in range(3):
+        document.new_page(100, 100)
+    filename = tmp_path.joinpath("document.pdf")
+    document.save(filename)
+    monkeypatch.setenv("ULM_CACHE", str(tmp_path.joinpath("cache")))
+
+    def partition_pdf(filename, strategy):
+        pages = len(pdfium.PdfDocument(filename))
+        return [
+            element(text, metadata=ElementMetadata(page_number=page))
+            for page in range(1, pages + 1)
+            for element, text in [
+                (Text, f"Figure {'AB'[page - 1]} of {filename}."),
+                (NarrativeText, f"Paragraph {page} of {filename}."),
+            ]
+        ]
+
+    # pages are numbered within page ranges
+    verdicts = lambda batch: [("Figure A" in e.text, "") for e in batch]
+    with patch(
+        "unstructured.partition.pdf.partition_pdf", side_effect=partition_pdf
+    ), patch("ulm.pdf.is_garbage_batch", side_effect=verdicts) as batch:
+        collection = ingest_pdf(tmp_path.joinpath("document.pdf"), tmp_path, pages=2)
+
+    assert batch.called
+    documents = collection.get()["documents"]
+    assert len(documents) == 4
+    assert [d for d in documents if "Figure" in d][0].startswith("Figure B")
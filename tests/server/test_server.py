@@ -0,0 +1,60 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ulm.server import AskServer, ask_server
+
+
+def test_ask_server(tmp_path):
+    assert ask_server(tmp_path, "question") is None
+
+    barrier = threading.Barrier(3, timeout=5)
+
+    def answer(question, cached, budget=100):
+        barrier.wait()  # all requests are handled at the same time
+        return f"{question}: {cached} {budget}"
+
+    server = AskServer(tmp_path, 0, answer)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        while not tmp_path.joinpath("server.json").exists():
+            pass
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(ask_server, tmp_path, "a", cache=False),
+                executor.submit(ask_server, tmp_path, "b", cache=False),
+                executor.submit(ask_server, tmp_path, "c", budget=5),
+            ]
+            answers = [future.result() for future in futures]
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    assert answers == ["a: False 100", "b: False 100", "c: True 5"]
+    assert ask_server(tmp_path, "question") is None
+
+
+def test_ask_server_fails(tmp_path, capsys):
+    def answer(question, cached):
+        if question == "slow":
+            time.sleep(1)
+        raise RuntimeError("no collection")
+
+    server = AskServer(tmp_path, 0, answer)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        while not tmp_path.joinpath("server.json").exists():
+            pass
+
+        # the question is answered without the server
+        assert ask_server(tmp_path, "question") is None
+        assert "no collection" in capsys.readouterr().err
+        assert ask_server(tmp_path, "slow", timeout=0.1) is None
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ["unstructured", "chromadb", "numpy", "tiktoken", "pypdfium2", "dotenv"]
+
+
+def import_profile(module: str) -> tuple[float, set[str]]:
+    """
+    Cumulative import time of `module` in seconds and all modules it imported,
+    in a fresh interpreter without any configuration in environment
+    """
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if not key.startswith(("OPENAI_", "LOCATION_", "OPENWEATHERMAP_"))
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative, imported = 0.0, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line[12:]:
+            continue
+        _, total, name = line[12:].split("|")
+        if name.strip() == module:
+            cumulative = int(total) / 1e6
+        imported.add(name.strip().split(".")[0])
+    return cumulative, imported
+
+
+@pytest.mark.parametrize("module,budget", [("ulm.pdf", 0.5), ("ulm.weather", 0.5)])
+def test_entry_point_import_budget(module, budget):
+    cumulative, imported = import_profile(module)
+    assert imported.isdisjoint(HEAVY)
+    assert 0 < cumulative < budget
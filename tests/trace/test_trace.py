@@ -0,0 +1,41 @@
+import json
+import threading
+
+import pytest
+
+import ulm.trace as trace
+
+
+def test_span_disabled():
+    with trace.span("stage", size=1) as attributes:
+        attributes["tokens"] = 1
+    assert trace._tracer is None
+
+
+def test_profiled(tmp_path, capsys):
+    filename = tmp_path.joinpath("trace.json")
+    with trace.profiled(filename):
+        with trace.span("llm/chat/completions", model="m") as span:
+            span["prompt_tokens"] = 10
+            span["completion_tokens"] = 5
+
+        def fetch():
+            with trace.span("weather.fetch"):
+                pass
+
+        worker = threading.Thread(target=fetch)
+        worker.start()
+        worker.join()
+        with pytest.raises(ValueError), trace.span("merge"):
+            raise ValueError("interrupted")
+    assert trace._tracer is None
+
+    events = json.loads(filename.read_text())["traceEvents"]
+    assert [e["name"] for e in events] == ["llm/chat/completions", "weather.fetch", "merge"]
+    assert events[0]["args"] == {"model": "m", "prompt_tokens": 10, "completion_tokens": 5}
+    assert events[0]["tid"] != events[1]["tid"]
+    assert events[2]["args"]["error"] == "ValueError('interrupted')"
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+
+    (llm,) = [line for line in capsys.readouterr().err.splitlines() if "llm" in line]
+    assert llm.split()[1] == "1" and llm.split()[-1] == "15"
@@ -0,0 +1,73 @@
+import numpy as np
+
+from ulm.vectors import NumpyIndex
+
+
+def embed(texts):
+    return [[float(len(text)), float(text.count("a")), 1.0] for text in texts]
+
+
+def test_numpy_index(tmp_path):
+    documents = ["a", "banana", "cherry", "avocado", "kiwi"]
+    batches = [
+        {
+            "ids": [f"id{i}" for i in range(start, stop)],
+            "documents": documents[start:stop],
+            "metadatas": [{"page": i} for i in range(start, stop)],
+        }
+        for start, stop in [(0, 2), (2, 4), (4, 5)]
+    ]
+    NumpyIndex.build(batches, tmp_path, embed)
+
+    index = NumpyIndex(tmp_path, embed)
+    assert index.count() == 5
+    assert isinstance(index.embeddings, np.memmap)
+
+    result = index.query(query_texts="papaya", n_results=3)
+
+    query = np.array(embed(["papaya"])[0])
+    matrix = np.array(embed(documents))
+    similarity = matrix @ query / np.linalg.norm(matrix, axis=1) / np.linalg.norm(query)
+    expected = np.argsort(-similarity)[:3]
+    assert result["ids"] == [[f"id{i}" for i in expected]]
+    assert result["documents"] == [[documents[i] for i in expected]]
+    assert result["metadatas"] == [[{"page": int(i)} for i in expected]]
+    np.testing.assert_allclose(
+        result["distances"][0], 1 - similarity[expected], atol=1e-6
+    )
+
+
+def test_empty_numpy_index(tmp_path):
+    index = NumpyIndex.build([], tmp_path, embed)
+    assert index.query(query_texts=["question"], n_results=5, include=["documents"]) == {
+        "ids": [[]],
+        "documents": [[]],
+    }
+
+
+def test_numpy_index_rebuild_keeps_open_index(tmp_path):
+    batch = lambda documents: {
+        "ids": documents,
+        "documents": documents,
+        "metadatas": [{"page": 1} for _ in documents],
+    }
+    first = NumpyIndex.build([batch(["kiwi"])], tmp_path, embed)
+    old = NumpyIndex.build([batch(["a", "banana"])], tmp_path, embed)
+    new = NumpyIndex.build([batch(["cherry", "kiwi", "avocado"])], tmp_path, embed)
+
+    assert old.embeddings.shape[0] == 2
+    assert old.query(query_texts="aa", n_results=1)["ids"] == [["a"]]
+    assert new.count() == 3
+    # the table is switched at once, with the matrix of its revision
+    reopened = NumpyIndex(tmp_path, embed)
+    assert reopened.metadata == new.metadata
+    assert reopened.embeddings.shape[0] == 3
+    # the previous matrix is kept for readers of the previous table
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        [
+            NumpyIndex.matrix(tmp_path, old.metadata["revision"]).name,
+            NumpyIndex.matrix(tmp_path, new.metadata["revision"]).name,
+            NumpyIndex.table_name,
+        ]
+    )
+    assert first.count() == 1
@@ -0,0 +1,108 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from ulm.weather import Weather, WeatherCache, advise_locations, current_weather
+
+
+def owm_response(dt: float) -> dict:
+    return {
+        "dt": dt,
+        "sys": {"sunrise": dt - 3600, "sunset": dt + 3600},
+        "main": {"temp": 20.0, "feels_like": 19.0, "pressure": 1000, "humidity": 50},
+        "wind": {"speed": 3.0},
+        "clouds": {"all": 10},
+    }
+
+
+def test_current_weather_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENWEATHERMAP_KEY", "key")
+    cache = WeatherCache(tmp_path)
+    now = time.time()
+    http = MagicMock()
+    http.get.return_value.json.return_value = owm_response(now - 60)
+
+    with patch("ulm.weather.session", return_value=http):
+        first = current_weather("1.0", "2.0", cache=cache)
+        second = current_weather("1.0", "2.0", cache=cache)
+        assert http.get.call_count == 1
+        assert first.datapoint_time == second.datapoint_time
+
+        current_weather("1.0", "3.0", cache=cache)
+        assert http.get.call_count == 2
+
+    # the datapoint is old and was fetched long ago: ask upstream, which fails
+    cache.put("1.0", "2.0", "metric", owm_response(now - 3600))
+    entry = cache.get("1.0", "2.0", "metric")
+    assert entry is not None
+    assert WeatherCache.fresh(entry, now)  # just fetched
+    assert not WeatherCache.fresh(entry, now + 120)
+
+    http.get.side_effect = requests.ConnectionError()
+    with patch("ulm.weather.session", return_value=http), patch(
+        "ulm.weather.time.time", return_value=now + 120
+    ):
+        stale = current_weather("1.0", "2.0", cache=cache)
+        assert http.get.call_count == 3
+        assert stale.temperature_celcius == 20.0
+
+        with pytest.raises(requests.ConnectionError):
+            current_weather("5.0", "6.0", cache=cache)
+
+
+def test_advise_locations_concurrently(monkeypatch):
+    def slow_weather(latitude, longitude, units="metric", cache=None):
+        if latitude == "0":
+            raise requests.HTTPError("404")
+        time.sleep(0.2)
+        return Weather.from_openweathermap(owm_response(time.time()))
+
+    def slow_advice(weather, activity):
+        time.sleep(0.2)
+        return f"dress for {activity}"
+
+    monkeypatch.setattr("ulm.weather.current_weather", slow_weather)
+    monkeypatch.setattr("ulm.weather.what_to_wear", slow_advice)
+    locations = [
+        {"latitude": 1, "longitude": 2, "activity": "run"},
+        {"latitude": 1, "longitude": 2, "activity": "walk"},
+        {"latitude": 3, "longitude": 4, "activity": "swim"},
+        {"latitude": 0, "longitude": 0, "activity": "fly"},
+    ]
+
+    started = time.perf_counter()
+    results = list(advise_locations(locations, concurrency=4))
+    assert time.perf_counter() - started < 0.6
+
+    by_activity = {r["activity"]: r for r in results}
+    assert by_activity["run"]["advice"] == "dress for run"
+    assert "Temperature: 20.0" in by_activity["swim"]["weather"]
+    assert "404" in by_activity["fly"]["error"]
+    assert "advice" not in by_activity["fly"]
+
+
+def test_advise_locations_limits_fetches(monkeypatch):
+    lock = threading.Lock()
+    running, peak = 0, 0
+
+    def slow_weather(latitude, longitude, units="metric", cache=None):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return Weather.from_openweathermap(owm_response(time.time()))
+
+    monkeypatch.setattr("ulm.weather.current_weather", slow_weather)
+    monkeypatch.setattr("ulm.weather.what_to_wear", lambda weather, activity: "")
+    locations = [{"latitude": i, "longitude": i} for i in range(12)]
+
+    results = list(advise_locations(locations, fetches=3))
+
+    assert len(results) == 12
+    assert peak == 3